@@ -8,15 +8,31 @@ import octoprint.plugin
 from flask import render_template, request, jsonify
 from octoprint.events import Events
 from octoprint.server import admin_permission
-from .printer_manage import printer_manager_instance, PrinterInfo
+from .printer_manage import printer_manager_instance, storage_sampler_instance, PrinterInfo
 from .cloud_task import CloudTask
-from .sqlite_util import SqliteServer
+from .sqlite_util import sqlite_server_instance
 from .raisecloud import RaiseCloud, get_access_key
+from .http_client import close_clients
+from .download_scheduler import download_scheduler_instance
+from .webcam import shutdown_webcam
 
 _logger = logging.getLogger('octoprint.plugins.raisecloud')
 
+# 这些事件发生时立即推送打印机状态
+TELEMETRY_EVENTS = (Events.PRINTER_STATE_CHANGED, Events.PRINT_STARTED, Events.PRINT_PAUSED,
+                    Events.PRINT_RESUMED, Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED)
+
+# 这些事件发生时刷新缓存的打印机配置、摄像头地址、名称和机型
+STATIC_INFO_EVENTS = tuple(e for e in (Events.SETTINGS_UPDATED, Events.PRINTER_PROFILE_MODIFIED, Events.CONNECTED,
+                                       Events.FIRMWARE_DATA, getattr(Events, "CONNECTIVITY_CHANGED", None)) if e)
+
+# local 存储的文件变化，更新文件索引和缓存
+STORAGE_EVENTS = tuple(e for e in (Events.FILE_ADDED, Events.FILE_REMOVED, Events.FOLDER_ADDED, Events.FOLDER_REMOVED,
+                                   getattr(Events, "FILE_MOVED", None), getattr(Events, "FOLDER_MOVED", None)) if e)
+
 
 class RaisecloudPlugin(octoprint.plugin.StartupPlugin,
+                       octoprint.plugin.ShutdownPlugin,
                        octoprint.plugin.TemplatePlugin,
                        octoprint.plugin.SettingsPlugin,
                        octoprint.plugin.AssetPlugin,
@@ -38,7 +54,25 @@ class RaisecloudPlugin(octoprint.plugin.StartupPlugin,
         return dict(
             printer_name=printer_name,
             machine_id=machine_id,
-            machine_type="other"
+            machine_type="other",
+            telemetry_coalesce_ms=250,
+            telemetry_resync_interval=300,
+            storage_sample_interval=60,
+            job_queue_size=5,
+            job_queue_auto_start=False,
+            download_limit_kbps=0,
+            download_limit_kbps_printing=512,
+            download_adaptive=True,
+            download_segments=1,
+            clean_high_watermark_mb=500,
+            clean_low_watermark_mb=400,
+            search_match_limit=500,
+            webcam_stream_grabber=False,
+            webcam_grabber_idle_timeout=30,
+            live_view_max_fps=5,
+            live_view_timeout=15,
+            live_view_cpu_budget=25,
+            snapshot_profile="original"
         )
 
     def get_template_vars(self):
@@ -62,11 +96,20 @@ class RaisecloudPlugin(octoprint.plugin.StartupPlugin,
 
     def on_after_startup(self):
         self.set_printer_identity()
-        self.sqlite_server = SqliteServer(self)
+        self.sqlite_server = sqlite_server_instance(self)
         self.sqlite_server.init_db()
+        printer_manager_instance(self).remove_stale_files()
         # check
         self.check_user_info()
 
+    def on_shutdown(self):
+        storage_sampler_instance(self).stop()
+        printer_manager_instance(self).folder_index.stop()
+        shutdown_webcam()
+        close_clients()
+        if hasattr(self, 'sqlite_server'):
+            self.sqlite_server.close_all()
+
     def on_event(self, event, payload):
 
         if event == Events.FIRMWARE_DATA:
@@ -75,18 +118,35 @@ class RaisecloudPlugin(octoprint.plugin.StartupPlugin,
                 self._settings.set(['machine_type'], machine_type)
                 self._settings.save()
 
+        if event in (Events.FILE_ADDED, Events.FILE_REMOVED):
+            storage_sampler_instance(self).trigger()
+
+        if event in STORAGE_EVENTS and payload.get("storage", payload.get("source_storage")) == "local":
+            printer_manager_instance(self).on_storage_event(event, payload)
+
         if not hasattr(self, 'cloud_task'):
             return
 
+        if event in STATIC_INFO_EVENTS:
+            self.cloud_task.printer_info.invalidate()
+
+        if event in TELEMETRY_EVENTS:
+            self.cloud_task.request_push()
+
         if event == Events.PRINT_STARTED:
             self.cloud_task.notify()
 
         if event == Events.PRINT_CANCELLED:
             self.cancelled = True
 
+        if event in (Events.PRINT_CANCELLED, Events.PRINT_FAILED):
+            # 取消或失败后同样需要确认打印平台已清空
+            self.cloud_task.job_queue.on_print_done()
+
         if event == Events.PRINT_DONE:
             # 完成消息
             self.cloud_task.on_event(state=1)
+            self.cloud_task.job_queue.on_print_done()
 
         if event == Events.CONNECTED:
             # reboot消息
@@ -162,6 +222,8 @@ class RaisecloudPlugin(octoprint.plugin.StartupPlugin,
         self.sqlite_server.set_login_status("logout")
         self.status = "logout"
         self.sqlite_server.delete_content()
+        if hasattr(self, 'cloud_task'):
+            self.cloud_task.request_push()
         self._logger.info("user logout ...")
         time.sleep(1)
         return jsonify({"status": "logout"}), 200, {'ContentType': 'application/json'}
@@ -175,12 +237,24 @@ class RaisecloudPlugin(octoprint.plugin.StartupPlugin,
             if res:
                 user_name, group_name, group_owner = res
                 printer_name = self._settings.get(["printer_name"])
+                waiting_bed_clear = hasattr(self, 'cloud_task') and self.cloud_task.job_queue.waiting_bed_clear
                 return jsonify({"status": "login", "user_name": user_name,
                                 "printer_name": printer_name, "group_name": group_name,
-                                "group_owner": group_owner}), 200, {'ContentType': 'application/json'}
+                                "group_owner": group_owner,
+                                "waiting_bed_clear": waiting_bed_clear}), 200, {'ContentType': 'application/json'}
 
         return jsonify({"status": "logout"}), 200, {'ContentType': 'application/json'}
 
+    @octoprint.plugin.BlueprintPlugin.route("/queue/bed_clear", methods=["POST"])
+    @admin_permission.require(403)
+    def bed_clear(self):
+        # 确认打印平台已清空，开始队列中的下一个任务
+        if hasattr(self, 'cloud_task') and self.cloud_task.job_queue.confirm_bed_clear():
+            self._logger.info("bed clear confirmed, start next queued task ...")
+            self.send_event("BedClearConfirmed")
+            return jsonify({"status": "success"}), 200, {'ContentType': 'application/json'}
+        return jsonify({"status": "failed", "msg": "no queued task"}), 200, {'ContentType': 'application/json'}
+
     @octoprint.plugin.BlueprintPlugin.route("/printer", methods=["POST"])
     @admin_permission.require(403)
     def change_name(self):
@@ -188,6 +262,8 @@ class RaisecloudPlugin(octoprint.plugin.StartupPlugin,
             printer_name = request.json["printer_name"]
             self._settings.set(['printer_name'], printer_name)
             self._settings.save()
+            if hasattr(self, 'cloud_task'):
+                self.cloud_task.printer_info.invalidate()
             self._logger.info("change printer name success, new name: %s" % printer_name)
             return jsonify({"status": "success"}), 200, {'ContentType': 'application/json'}
         self._logger.info("change printer name failed ...")
@@ -206,6 +282,9 @@ class RaisecloudPlugin(octoprint.plugin.StartupPlugin,
             )
         )
 
+    def on_gcode_sent(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+        download_scheduler_instance(self).on_gcode_sent()
+
     def send_event(self, event, data=None):
         event = {'event': event, 'data': data}
         self._plugin_manager.send_plugin_message(self._plugin_name, event)
@@ -252,5 +331,6 @@ def __plugin_load__():
 
     global __plugin_hooks__
     __plugin_hooks__ = {
-        "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information
+        "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
+        "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.on_gcode_sent
     }
@@ -6,13 +6,19 @@ import json
 import socket
 import hashlib
 import logging
-import requests
 import threading
+from octoprint.printer import PrinterCallback
 from .webcam import webcam_instance
-from .websocket_server import WebsocketServer
+from .http_client import cloud_client
+from .websocket_server import WebsocketServer, is_critical
 from .printer_manage import PrinterInfo, printer_manager_instance
-from .sqlite_util import SqliteServer
+from .sqlite_util import sqlite_server_instance, Outbox
 from .policy import ReconnectionPolicy
+from .delta import DeltaEngine
+from .dispatcher import CommandDispatcher
+from .job_queue import JobQueue
+from .download_scheduler import download_scheduler_instance
+from .live_view import LiveView, LIVE_VIEW_TYPE
 
 _logger = logging.getLogger('octoprint.plugins.raisecloud')
 
@@ -25,35 +31,79 @@ class CloudTask(object):
         self.printer = None
         self.printer_info = PrinterInfo(plugin)
         self.printer_manager = printer_manager_instance(plugin)
-        self.sqlite_server = SqliteServer(plugin)
-        self.diff_dict = dict()
-        self.previous_dict = dict()
+        self.sqlite_server = sqlite_server_instance(plugin)
+        self.outbox = Outbox(self.sqlite_server)
+        self.job_queue = JobQueue(plugin, self.printer_manager, self.sqlite_server,
+                                  on_start=self._start_queued_job, on_failed=self._queued_job_failed)
+        self.delta_engine = DeltaEngine()
+        # 打印机状态有更新时唤醒 event_loop
+        self._push_event = threading.Event()
+        self._printer_callback = TelemetryCallback(self)
+        self.live_view = LiveView(plugin, webcam_instance(plugin), self._send_ws_data, self._ws_metrics,
+                                  lambda: {"machine_id": self._get_machine_id()["machine_id"],
+                                           "token": self._get_token()["token"]})
+        self.dispatcher = self._create_dispatcher()
+
+    def _create_dispatcher(self):
+        # 暂停、终止等控制指令单独使用一个线程，不会被文件列表等慢操作阻塞
+        dispatcher = CommandDispatcher()
+        dispatcher.register(4, self._handle_push_down, "control")
+        dispatcher.register(5, self._handle_printer_setting, "control")
+        dispatcher.register(8, self._handle_receive_job, "control")
+        dispatcher.register(9, self._handle_cancel_download, "control")
+        dispatcher.register(2, self._handle_print_job, "job")
+        dispatcher.register(7, self._handle_print_local_file, "job")
+        dispatcher.register(6, self._handle_file_list, "file")
+        dispatcher.register(10, self._handle_snapshot, "webcam")
+        dispatcher.register(LIVE_VIEW_TYPE, self.live_view.on_message, "webcam")
+        dispatcher.register(11, self._handle_token_error, "account")
+        dispatcher.register(13, self._handle_remote_setting, "account")
+        return dispatcher
+
+    def _ws_metrics(self):
+        # 未连接时返回 None
+        return self.websocket.metrics() if self.websocket and self.websocket.connected() else None
+
+    def request_push(self):
+        self._push_event.set()
 
     def _send_ws_data(self, data, message_type=None):
         if not self.websocket:
-            return
+            # 尚未连接，任务状态消息保存到离线发件箱
+            if is_critical(data):
+                self.outbox.append(data)
+            return False
         try:
-            self.websocket.send_text(data)
+            return self.websocket.send_text(data)
         except:
             import traceback
             traceback.print_exc()
+            return False
+
+    def _on_undelivered(self, data):
+        self.outbox.append(data)
+        self.request_push()
+
+    def replay_outbox(self):
+        # 重新连接后按顺序补发离线期间的任务状态消息
+        for message in self.outbox.pop_all():
+            message["token"] = self._get_token()["token"]
+            message["machine_id"] = self._get_machine_id()["machine_id"]
+            _logger.info("Replay offline message type %s to cloud." % message["message_type"])
+            self._send_ws_data(message)
 
     def _set_token(self, token):
         """
-    status: receive job status
-    """
-        sql = 'UPDATE profile SET token = ? WHERE id = ? '
-        data = [(token, 1)]
-        self.sqlite_server.update(sql, data)
+        token: cloud api token
+        """
+        self.sqlite_server.set_token(token)
 
     def _get_token(self):
         """
         :return: "{}
         token": cloud_api_token,
         """
-        fetchone_sql = 'SELECT token FROM profile WHERE ID = ? '
-        res = self.sqlite_server.fetchone(fetchone_sql, 1)
-        return {"token": res[0]} if res else {}
+        return {"token": self.sqlite_server.get_token()}
 
     def _get_machine_id(self):
         """
@@ -66,17 +116,14 @@ class CloudTask(object):
         """
         status: receive job status
         """
-        sql = 'UPDATE profile SET receive_job = ? WHERE id = ? '
-        data = [(status, 1)]
-        self.sqlite_server.update(sql, data)
+        self.sqlite_server.set_receive_job(status)
 
     def _get_receive_job(self):
         """
         :return: receive job status  accept or refuse
         """
-        sql = 'SELECT receive_job FROM profile WHERE ID = ? '
-        res = self.sqlite_server.fetchone(sql, 1)
-        return {"status": res[0]} if res and res[0] else {"status": "accept"}
+        status = self.sqlite_server.get_receive_job()
+        return {"status": status} if status else {"status": "accept"}
 
     def _other_info(self):
         """
@@ -88,7 +135,9 @@ class CloudTask(object):
             "raise_touch_version": "1.0.2",
             "queue_state": 1 if self._get_receive_job()["status"] == "accept" else 0,
             "machine_id": self._get_machine_id()["machine_id"],
-            "token": self._get_token()["token"]
+            "token": self._get_token()["token"],
+            "job_queue_depth": self.job_queue.depth(),
+            "download_kbps": download_scheduler_instance(self.plugin).throughput_kbps()
         }
 
     def _get_send_data(self):
@@ -136,7 +185,7 @@ class CloudTask(object):
                     "machine_id": self._get_machine_id()["machine_id"],
                     "reboot": True}
             }
-            self.websocket.send_text(reboot_data)
+            self._send_ws_data(reboot_data)
             # _logger.info("send reboot message to cloud {}".format(reboot_data))
             return
 
@@ -150,7 +199,7 @@ class CloudTask(object):
                     "print_progress": "100.00",
                     "left_time": 0}
             }
-            self.websocket.send_text(process_data)
+            self._send_ws_data(process_data)
             # _logger.info("send complete process to cloud {}".format(process_data))
         if self.printer_manager.task_id == "not_remote_tasks":
             return
@@ -166,16 +215,23 @@ class CloudTask(object):
             }
         }
         # _logger.info("send complete message to cloud {}".format(result))
-        self.websocket.send_text(result)
+        self._send_ws_data(result)
         # clean up task_id
         self.printer_manager.task_id = "not_remote_tasks"
 
     def task_event_run(self):
+        self.plugin._printer.register_callback(self._printer_callback)
+        self.job_queue.resume()
         try:
             self.event_loop()
         except Exception as e:
             _logger.error("Task event error...")
             _logger.error(e)
+        finally:
+            self.plugin._printer.unregister_callback(self._printer_callback)
+            self.dispatcher.stop()
+            self.job_queue.stop()
+            self.live_view.stop()
 
     def resolve_addr(self, domain):
         result = socket.getaddrinfo(domain, None)
@@ -184,73 +240,75 @@ class CloudTask(object):
     def event_loop(self):
         last_heartbeat = 0
         policy = ReconnectionPolicy()
+        coalesce_window = self.plugin._settings.get_int(["telemetry_coalesce_ms"]) / 1000.0
+        resync_interval = self.plugin._settings.get_int(["telemetry_resync_interval"])
 
         while True:
             _logger.info("Raisecloud connecting ...")
             try:
                 addr = "wss://{}/octoprod-v1.1/websocket".format(self.resolve_addr("api.raise3d.com"))
                 self.websocket = WebsocketServer(url=addr,
-                                                 on_server_ws_msg=self._on_server_ws_msg)
+                                                 on_server_ws_msg=self._on_server_ws_msg,
+                                                 on_undelivered=self._on_undelivered)
                 wst = threading.Thread(target=self.websocket.run)
                 wst.daemon = True
                 wst.start()
                 time.sleep(2)
 
+                logout_event = self.sqlite_server.logout_event
+                last_resync = time.time()
                 while self.websocket.connected():
-                    status = self.sqlite_server.check_login_status()
-                    if status == "logout":
+                    if logout_event.is_set():
                         _logger.info("User quit, Raisecloud will disconnect ...")
                         break
 
+                    # 重新连接后，或连接正常但发送队列已满时存入的消息，在队列有空位时补发
+                    if self.outbox.pending and self.websocket.metrics()["depth"] < self.websocket.queue.maxsize // 2:
+                        self.replay_outbox()
+
                     if time.time() - last_heartbeat > 60:
                         self.send_heartbeat()
                         last_heartbeat = time.time()
 
+                    # 定时全量同步，防止增量消息丢失
+                    if time.time() - last_resync > resync_interval:
+                        _logger.debug("Telemetry delta stats: {}".format(self.delta_engine.stats()))
+                        _logger.debug("Send queue metrics: {}".format(self.websocket.metrics()))
+                        _logger.debug("Command timing: {}".format(self.dispatcher.stats()))
+                        _logger.debug("HTTP timing: {}".format(cloud_client().stats()))
+                        _logger.debug("Snapshot stats: {}".format(webcam_instance(self.plugin).stats()))
+                        _logger.debug("Live view stats: {}".format(self.live_view.stats()))
+                        self.delta_engine.reset()
+                        last_resync = time.time()
+
                     self.send_printer_info()
 
                     policy.reset()
-                    time.sleep(5)
+                    # 等待打印机回调、心跳或全量同步，合并窗口内的多次更新只发送一次
+                    timeout = min(last_heartbeat + 60, last_resync + resync_interval) - time.time()
+                    if self._push_event.wait(max(timeout, 0)):
+                        logout_event.wait(coalesce_window)
+                    self._push_event.clear()
             finally:
                 try:
                     self.websocket.disconnect()
                     # _logger.info("come into finally , current ws status: {}".format(self.websocket.connected()))
-                    if self.sqlite_server.check_login_status() == "logout":
+                    if self.sqlite_server.logout_event.is_set():
                         break
                 except:
                     pass
 
-                self.diff_dict = dict()
-                self.previous_dict = dict()
+                self.delta_engine.reset()
                 policy.more()
 
     def send_printer_info(self):
         try:
             send_data = self._get_send_data()
-            tmp_data = send_data["data"]
-            if self.previous_dict:
-                for key, value in send_data["data"].items():
-                    if key == "storage_avl_kb" and abs(self.previous_dict[key] - value) < 1024:
-                        continue  # 变化小于1M
-                    # profile 更改配置，增加属性nozzle等
-                    if key not in self.previous_dict:
-                        self.diff_dict[key] = value
-                        continue
-                    if self.previous_dict[key] != value:
-                        self.diff_dict[key] = value
-                if self.diff_dict:
-                    send_data["data"] = self.diff_dict
-                    send_data["data"].update({"machine_id": self._get_machine_id()["machine_id"]})
-                    # 防止网络异常丢失当前状态
-                    if "cur_print_state" not in send_data["data"].keys():
-                        send_data["data"]["cur_print_state"] = tmp_data["cur_print_state"]
-                    self._send_ws_data(send_data)
-                    # _logger.info("current printer info message: {}".format(send_data))
-                    self.diff_dict = {}
-
-            else:
+            frame = self.delta_engine.diff(send_data["data"])
+            if frame:
+                send_data["data"] = frame
                 self._send_ws_data(send_data)
                 # _logger.info("current printer info message: {}".format(send_data))
-            self.previous_dict = tmp_data
         except Exception as e:
             # _logger.error("socket printer info error ...")
             _logger.error(e)
@@ -263,307 +321,346 @@ class CloudTask(object):
             # _logger.error("Raisecloud ping error ...")
             _logger.error(e)
 
-    def _load_thread(self, download_url, filename):
-        success_data = {
+    def _print_start_data(self, task_id):
+        return {
             "state": 1,
             "message_type": 2,
             "machine_id": self._get_machine_id()["machine_id"],
             "token": self._get_token()["token"],
             "data": {
-                "task_id": self.printer_manager.task_id,
+                "task_id": task_id,
                 "print_state": 1,
                 "machine_id": self._get_machine_id()["machine_id"],
             }
         }
-        failed_data = {
+
+    def _download_failed_data(self, task_id):
+        return {
             "state": 0,
             "message_type": 9,
             "machine_id": self._get_machine_id()["machine_id"],
             "token": self._get_token()["token"],
             "data": {
-                "task_id": self.printer_manager.task_id,
+                "task_id": task_id,
                 "download_state": 0,
                 "machine_id": self._get_machine_id()["machine_id"],
             }
         }
-        load_thread = threading.Thread(target=self.printer_manager.load_thread, args=(download_url, filename, success_data, failed_data, self.websocket))
+
+    def _load_thread(self, download_url, filename, checksum=None):
+        success_data = self._print_start_data(self.printer_manager.task_id)
+        failed_data = self._download_failed_data(self.printer_manager.task_id)
+        load_thread = threading.Thread(target=self.printer_manager.load_thread, args=(download_url, filename, success_data, failed_data, self._send_ws_data, checksum))
         load_thread.daemon = True
         load_thread.start()
 
+    def _start_queued_job(self, task_id, file_path):
+        try:
+            self.printer_manager.task_id = task_id
+            abs_path = self.plugin._file_manager.path_on_disk("local", file_path)
+            self.plugin._printer.select_file(abs_path, sd=False, printAfterSelect=True)
+            self._send_ws_data(self._print_start_data(task_id))
+        except Exception as e:
+            _logger.error("Raisecloud start queued task error ...")
+            _logger.error(e)
+            self.printer_manager.task_id = "not_remote_tasks"
+            self._queued_job_failed(task_id)
+
+    def _queued_job_failed(self, task_id):
+        self._send_ws_data(self._download_failed_data(task_id))
+
     def _on_server_ws_msg(self, ws, message):
-        # 处理远程消息
+        # 处理远程消息，由分发器交给对应的工作线程执行，不阻塞接收线程
         # _logger.info("receive message from raisecloud: %s" % message)
-        mes = json.loads(message)
-        if mes["message_type"] == 2:
-            try:
-                if self._get_receive_job()["status"] == "accept":  # 状态为接受状态
-                    # 多任务时，只处理一个任务
-                    if self.printer_manager.downloading or self.plugin._printer.get_state_string() == "Printing":
+        self.dispatcher.dispatch(json.loads(message))
+
+    def _handle_print_job(self, mes):
+        # 处理云端下发的打印任务
+        try:
+            if self._get_receive_job()["status"] == "accept":  # 状态为接受状态
+                # 多任务时，只处理一个任务
+                download_url = mes["data"]["download_url"]
+                filename = hex_2_str(mes["data"]["print_file"])  # display name
+                if self.printer_manager.downloading or self.plugin._printer.get_state_string() == "Printing" or \
+                        self.job_queue.depth() or self.job_queue.waiting_bed_clear:
+                    # 打印中、队列中还有任务或等待确认打印平台已清空时，加入本地队列按顺序开始
+                    if not self.job_queue.enqueue(mes["data"]["task_id"], download_url, filename):
                         _logger.info("Current task is in progress ...")
-                        return
+                    return
 
-                    download_url = mes["data"]["download_url"]
-                    self.printer_manager.task_id = mes["data"]["task_id"]
-                    filename = hex_2_str(mes["data"]["print_file"])  # display name
-                    self._load_thread(download_url, filename)
-            except Exception as e:
-                _logger.error("Raisecloud file printing error ...")
-                _logger.error(e)
+                self.printer_manager.task_id = mes["data"]["task_id"]
+                # 云端提供压缩包 MD5 时作为本地缓存的标识，否则使用 ETag
+                self._load_thread(download_url, filename, mes["data"].get("file_md5"))
+        except Exception as e:
+            _logger.error("Raisecloud file printing error ...")
+            _logger.error(e)
 
-        if mes["message_type"] == 4:
-            # 接受 终止 暂停
-            try:
-                command = mes["data"]["push_down"]
-                if command == "pause":
-                    self.plugin._printer.pause_print()
-                if command == "resume":
-                    self.plugin._printer.resume_print()
-                if command == "stop":
-                    self.plugin._printer.cancel_print()
+    def _handle_push_down(self, mes):
+        # 接受 终止 暂停
+        try:
+            command = mes["data"]["push_down"]
+            if command == "pause":
+                self.plugin._printer.pause_print()
+            if command == "resume":
+                self.plugin._printer.resume_print()
+            if command == "stop":
+                self.plugin._printer.cancel_print()
+
+            result = {
+                "message_type": 4,
+                "state": 1,
+                "machine_id": self._get_machine_id()["machine_id"],
+                "token": self._get_token()["token"],
+                "data": {
+                    "machine_id": self._get_machine_id()["machine_id"]
+                }
+            }
+            # _logger.info("send {} message to cloud: {}".format(command, result))
+            self._send_ws_data(result)
+        except Exception as e:
+            _logger.error("Raisecloud setting push down error ...")
+            _logger.error(e)
 
-                result = {
-                    "message_type": 4,
-                    "state": 1,
+    def _handle_printer_setting(self, mes):
+        # 设置温度、速度、风扇、移动轴
+        try:
+            data = mes["data"]
+            if data:
+                invalid = "0.00"
+                if "bed_temp" in data:
+                    bed_temp = data["bed_temp"]
+                    if bed_temp != invalid:
+                        self.plugin._printer.set_temperature("bed", int(bed_temp[:-3]))
+                if "nozzle_temp_1" in data:
+                    temp_1 = data["nozzle_temp_1"]
+                    if temp_1 != invalid:
+                        self.plugin._printer.set_temperature("tool0", int(temp_1[:-3]))
+                if "nozzle_temp_2" in data:
+                    temp_2 = data["nozzle_temp_2"]
+                    if temp_2 != invalid:
+                        self.plugin._printer.set_temperature("tool1", int(temp_2[:-3]))
+
+                if "flow_rate_1" in data:  # 挤出机挤出速率
+                    flow_rate1 = data["flow_rate_1"]
+                    if flow_rate1 != invalid:
+                        self.plugin._printer.change_tool("tool0")
+                        self.plugin._printer.flow_rate(int(flow_rate1[:-3]))
+                if "flow_rate_2" in data:
+                    flow_rate2 = data["flow_rate_2"]
+                    if flow_rate2 != invalid:
+                        self.plugin._printer.change_tool("tool1")
+                        self.plugin._printer.flow_rate(int(flow_rate2[:-3]))
+
+                if "fan_speed" in data:
+                    fan_speed = data["fan_speed"]
+                    command = "M106 S{}".format(int(fan_speed[:-3]))
+                    self.plugin._printer.commands(command)  # args str
+
+                if "print_speed" in data:  # printer head移动速度
+                    feed_rate = data["print_speed"]
+                    if feed_rate != invalid:
+                        self.plugin._printer.feed_rate(int(feed_rate[:-3]))
+
+                if "jog" in data:
+                    jog = data["jog"]
+                    if jog:
+                        self.plugin._printer.jog(jog)  # args dict
+
+                if "home" in data:
+                    axes = []
+                    if "x" in data["home"] and data["home"]["x"] == "reset":
+                        axes.append("x")
+                    if "y" in data["home"] and data["home"]["y"] == "reset":
+                        axes.append("y")
+                    if "z" in data["home"] and data["home"]["z"] == "reset":
+                        axes.append("z")
+                    self.plugin._printer.home(axes)
+
+            result = {
+                "state": 1,
+                "message_type": 5,
+                "machine_id": self._get_machine_id()["machine_id"],
+                "token": self._get_token()["token"],
+                "data": {
                     "machine_id": self._get_machine_id()["machine_id"],
-                    "token": self._get_token()["token"],
-                    "data": {
-                        "machine_id": self._get_machine_id()["machine_id"]
-                    }
                 }
-                # _logger.info("send {} message to cloud: {}".format(command, result))
-                self.websocket.send_text(result)
-            except Exception as e:
-                _logger.error("Raisecloud setting push down error ...")
-                _logger.error(e)
+            }
+            # _logger.info("send printer setting message to cloud: {}".format(result))
+            self._send_ws_data(result)
+        except Exception as e:
+            _logger.error("Raisecloud setting error...")
+            _logger.error(e)
 
-        if mes["message_type"] == 5:
-            try:
-                data = mes["data"]
-                if data:
-                    invalid = "0.00"
-                    if "bed_temp" in data:
-                        bed_temp = data["bed_temp"]
-                        if bed_temp != invalid:
-                            self.plugin._printer.set_temperature("bed", int(bed_temp[:-3]))
-                    if "nozzle_temp_1" in data:
-                        temp_1 = data["nozzle_temp_1"]
-                        if temp_1 != invalid:
-                            self.plugin._printer.set_temperature("tool0", int(temp_1[:-3]))
-                    if "nozzle_temp_2" in data:
-                        temp_2 = data["nozzle_temp_2"]
-                        if temp_2 != invalid:
-                            self.plugin._printer.set_temperature("tool1", int(temp_2[:-3]))
-
-                    if "flow_rate_1" in data:  # 挤出机挤出速率
-                        flow_rate1 = data["flow_rate_1"]
-                        if flow_rate1 != invalid:
-                            self.plugin._printer.change_tool("tool0")
-                            self.plugin._printer.flow_rate(int(flow_rate1[:-3]))
-                    if "flow_rate_2" in data:
-                        flow_rate2 = data["flow_rate_2"]
-                        if flow_rate2 != invalid:
-                            self.plugin._printer.change_tool("tool1")
-                            self.plugin._printer.flow_rate(int(flow_rate2[:-3]))
-
-                    if "fan_speed" in data:
-                        fan_speed = data["fan_speed"]
-                        command = "M106 S{}".format(int(fan_speed[:-3]))
-                        self.plugin._printer.commands(command)  # args str
-
-                    if "print_speed" in data:  # printer head移动速度
-                        feed_rate = data["print_speed"]
-                        if feed_rate != invalid:
-                            self.plugin._printer.feed_rate(int(feed_rate[:-3]))
-
-                    if "jog" in data:
-                        jog = data["jog"]
-                        if jog:
-                            self.plugin._printer.jog(jog)  # args dict
-
-                    if "home" in data:
-                        axes = []
-                        if "x" in data["home"] and data["home"]["x"] == "reset":
-                            axes.append("x")
-                        if "y" in data["home"] and data["home"]["y"] == "reset":
-                            axes.append("y")
-                        if "z" in data["home"] and data["home"]["z"] == "reset":
-                            axes.append("z")
-                        self.plugin._printer.home(axes)
+    def _handle_file_list(self, mes):
+        # 查询本地文件列表
+        start = int(mes["data"]["start"])
+        length = int(mes["data"]["length"])
+        keyword = mes["data"]["keyword"]
+        if keyword:
+            keyword = keyword
+        dir_path = mes["data"]["dir_path"]
+        try:
+            # regex 为可选字段，为 1 时 keyword 按正则表达式匹配
+            file_data = self.printer_manager.get_files(path=dir_path, keyword=keyword, start=start, length=length,
+                                                       regex=bool(mes["data"].get("regex")))
+            file_data.update({"machine_id": self._get_machine_id()["machine_id"]})
+            result = {
+                "state": 1,
+                "message_type": 6,
+                "machine_id": self._get_machine_id()["machine_id"],
+                "token": self._get_token()["token"],
+                "data": file_data
+            }
+            # _logger.info("send file data message to cloud: {}".format(result))
+            self._send_ws_data(result)
+        except Exception as e:
+            _logger.error("Raiseclud get file data error ...")
+            _logger.error(e)
 
+    def _handle_print_local_file(self, mes):
+        # 打印本地文件
+        if self._get_receive_job()["status"] == "accept":  # 状态为接受状态
+            print_file = mes["data"]["print_file"].replace("/local/", "")
+            try:
+                self.printer_manager.task_id = ""
+                local_abs_path = self.plugin._file_manager.path_on_disk("local", "")  # local绝对路径
+                path = os.path.join(local_abs_path, print_file)
+                if "\\" in local_abs_path:
+                    path = path.replace('/', '\\')
+                self.plugin._printer.select_file(path, sd=False, printAfterSelect=True)
                 result = {
+                    "message_type": "7",
                     "state": 1,
-                    "message_type": 5,
                     "machine_id": self._get_machine_id()["machine_id"],
-                    "token": self._get_token()["token"],
                     "data": {
-                        "machine_id": self._get_machine_id()["machine_id"],
+                        "machine_id": self._get_machine_id()["machine_id"]
                     }
                 }
-                # _logger.info("send printer setting message to cloud: {}".format(result))
-                self.websocket.send_text(result)
+                # _logger.info("send print local file message to the cloud: {}".format(result))
+                self._send_ws_data(result)
+
             except Exception as e:
-                _logger.error("Raisecloud setting error...")
+                _logger.error("Raisecloud print local file error ...")
                 _logger.error(e)
 
-        if mes["message_type"] == 6:
-            start = int(mes["data"]["start"])
-            length = int(mes["data"]["length"])
-            keyword = mes["data"]["keyword"]
-            if keyword:
-                keyword = keyword
-            dir_path = mes["data"]["dir_path"]
-            try:
-                file_data = self.printer_manager.get_files(path=dir_path, keyword=keyword, start=start, length=length)
-                file_data.update({"machine_id": self._get_machine_id()["machine_id"]})
-                result = {
-                    "state": 1,
-                    "message_type": 6,
+    def _handle_receive_job(self, mes):
+        # 设置是否接收任务
+        try:
+            receive = int(mes["data"]["receive_job_set"])
+            self._set_receive_job("accept") if receive else self._set_receive_job("refuse")
+            reply_message = {
+                "message_type": 8,
+                "source": 1,
+                "machine_id": self._get_machine_id()["machine_id"],
+                "token": self._get_token()["token"],
+                "data": {
                     "machine_id": self._get_machine_id()["machine_id"],
-                    "token": self._get_token()["token"],
-                    "data": file_data
+                    "queue_state": 1 if receive else 0,  # 0禁用 1启用
                 }
-                # _logger.info("send file data message to cloud: {}".format(result))
-                self.websocket.send_text(result)
-            except Exception as e:
-                _logger.error("Raiseclud get file data error ...")
-                _logger.error(e)
+            }
 
-        if mes["message_type"] == 7:
-            if self._get_receive_job()["status"] == "accept":  # 状态为接受状态
-                print_file = mes["data"]["print_file"].replace("/local/", "")
-                try:
-                    self.printer_manager.task_id = ""
-                    local_abs_path = self.plugin._file_manager.path_on_disk("local", "")  # local绝对路径
-                    path = os.path.join(local_abs_path, print_file)
-                    if "\\" in local_abs_path:
-                        path = path.replace('/', '\\')
-                    self.plugin._printer.select_file(path, sd=False, printAfterSelect=True)
-                    result = {
-                        "message_type": "7",
-                        "state": 1,
-                        "machine_id": self._get_machine_id()["machine_id"],
-                        "data": {
-                            "machine_id": self._get_machine_id()["machine_id"]
-                        }
-                    }
-                    # _logger.info("send print local file message to the cloud: {}".format(result))
-                    self.websocket.send_text(result)
+            # _logger.info("send accept job message to cloud: {}".format(reply_message))
+            self._send_ws_data(reply_message)
 
-                except Exception as e:
-                    _logger.error("Raisecloud print local file error ...")
-                    _logger.error(e)
+        except Exception as e:
+            _logger.error("Raisecloud set receive job error ...")
+            _logger.error(e)
 
-        if mes["message_type"] == 8:
-            try:
-                receive = int(mes["data"]["receive_job_set"])
-                self._set_receive_job("accept") if receive else self._set_receive_job("refuse")
-                reply_message = {
-                    "message_type": 8,
-                    "source": 1,
+    def _handle_cancel_download(self, mes):
+        # 取消下载
+        try:
+            cancel = int(mes["data"]["cancle_download_set"])
+            # 确保下载中才能执行取消操作，
+            if cancel and self.printer_manager.downloading:
+                self.printer_manager.cancel = True
+                self.printer_manager.manual = True
+                # 回复消息
+                reply_data = {
+                    "state": 1,
+                    "message_type": 9,
                     "machine_id": self._get_machine_id()["machine_id"],
                     "token": self._get_token()["token"],
                     "data": {
+                        "task_id": self.printer_manager.task_id,
+                        "download_state": 1,
                         "machine_id": self._get_machine_id()["machine_id"],
-                        "queue_state": 1 if receive else 0,  # 0禁用 1启用
                     }
                 }
+                self._send_ws_data(reply_data)
+                _logger.info("Raiselcoud cancel downloading file.")
+                # 刷新消息
+                send_data = self._get_send_data()
+                self._send_ws_data(send_data)
+                # _logger.info("cancel download and send all data: {}".format(send_data))
 
-                # _logger.info("send accept job message to cloud: {}".format(reply_message))
-                self.websocket.send_text(reply_message)
-
-            except Exception as e:
-                _logger.error("Raisecloud set receive job error ...")
-                _logger.error(e)
-
-        if mes["message_type"] == 9:
-            try:
-                cancel = int(mes["data"]["cancle_download_set"])
-                # 确保下载中才能执行取消操作，
-                if cancel and self.printer_manager.downloading:
-                    self.printer_manager.cancel = True
-                    self.printer_manager.manual = True
-                    # 回复消息
-                    reply_data = {
-                        "state": 1,
-                        "message_type": 9,
-                        "machine_id": self._get_machine_id()["machine_id"],
-                        "token": self._get_token()["token"],
-                        "data": {
-                            "task_id": self.printer_manager.task_id,
-                            "download_state": 1,
-                            "machine_id": self._get_machine_id()["machine_id"],
-                        }
-                    }
-                    self.websocket.send_text(reply_data)
-                    _logger.info("Raiselcoud cancel downloading file.")
-                    # 刷新消息
-                    send_data = self._get_send_data()
-                    self._send_ws_data(send_data)
-                    # _logger.info("cancel download and send all data: {}".format(send_data))
+            else:
+                _logger.info("Ineffective operation, no file is downloading.")
 
-                else:
-                    _logger.info("Ineffective operation, no file is downloading.")
+        except Exception as e:
+            _logger.error("Raisecloud cancel downloading file error ...")
+            _logger.error(e)
 
-            except Exception as e:
-                _logger.error("Raisecloud cancel downloading file error ...")
-                _logger.error(e)
+    def _handle_snapshot(self, mes):
+        # 上传摄像头截图
+        webcam = webcam_instance(self.plugin)
+        webcam.upload_snapshot(self._get_machine_id()["machine_id"], self._get_token()["token"])
 
-        if mes["message_type"] == 10:
-            webcam = webcam_instance(self.plugin)
-            webcam.upload_snapshot(self._get_machine_id()["machine_id"], self._get_token()["token"])
+    def _handle_token_error(self, mes):
+        # 刷新token或强制下线
+        try:
+            error_code = int(mes["data"]["error_code"])
+            if error_code == 2:
+                # 刷新token
+                # _logger.info("remotely force users to flash token .")
+                token = self.flash_token(machine_id=self._get_machine_id()["machine_id"])
+                # 写入token
+                if token:
+                    self._set_token(token)
+                # 刷新消息
+                send_data = self._get_send_data()
+                send_data["token"] = token
+                send_data["data"]["token"] = token
+                self._send_ws_data(send_data)
+                # _logger.info("flask token and send all data: {}".format(send_data))
 
-        if mes["message_type"] == 11:
-            try:
-                error_code = int(mes["data"]["error_code"])
-                if error_code == 2:
-                    # 刷新token
-                    # _logger.info("remotely force users to flash token .")
-                    token = self.flash_token(machine_id=self._get_machine_id()["machine_id"])
-                    # 写入token
-                    if token:
-                        self._set_token(token)
-                    # 刷新消息
-                    send_data = self._get_send_data()
-                    send_data["token"] = token
-                    send_data["data"]["token"] = token
-                    self._send_ws_data(send_data)
-                    # _logger.info("flask token and send all data: {}".format(send_data))
-
-                else:
-                    # 强制下线, 正常解绑或者团队解散用户删除解绑
-                    _logger.info("User logout ...")
-                    # 添加区分退出原因
-                    error_data = ""
-                    self.sqlite_server.set_login_status("logout")
-                    self.plugin.status = "logout"
-                    self.sqlite_server.delete_content()
-                    if error_code == 5:
-                        error_data = "Unknown error"
-                    if error_code == 6:
-                        error_data = "You have unbind in RaiseCloud"
-                    if error_code == 7:
-                        error_data = "Your team has been disbanded"
-                    if error_code == 9:
-                        error_data = "User no longer exists"
-                    self.plugin.send_event("Logout", data=error_data)
-            except Exception as e:
-                _logger.error(e)
+            else:
+                # 强制下线, 正常解绑或者团队解散用户删除解绑
+                _logger.info("User logout ...")
+                # 添加区分退出原因
+                error_data = ""
+                self.sqlite_server.set_login_status("logout")
+                self.plugin.status = "logout"
+                self.sqlite_server.delete_content()
+                self.request_push()
+                if error_code == 5:
+                    error_data = "Unknown error"
+                if error_code == 6:
+                    error_data = "You have unbind in RaiseCloud"
+                if error_code == 7:
+                    error_data = "Your team has been disbanded"
+                if error_code == 9:
+                    error_data = "User no longer exists"
+                self.plugin.send_event("Logout", data=error_data)
+        except Exception as e:
+            _logger.error(e)
 
-        if mes["message_type"] == 13:
-            data = mes["data"]
-            # 远程更改打印机名
-            if "printer_name" in data:
-                printer_name = mes["data"]["printer_name"]
-                self.plugin._settings.set(['printer_name'], printer_name)
-                self.plugin._settings.save()
-                self.plugin.send_event("ChangeName", printer_name)
-                _logger.info("Change printer name success, new name: %s" % printer_name)
-            # 远程更改配置文件
-            if "profile" in data:
-                profile = mes["data"]["profile"]
-                self.printer_manager.change_printer_profile(profile)
-                self.plugin.send_event("ChangeProfile")
-                _logger.info("Change current profile %s" % profile)
+    def _handle_remote_setting(self, mes):
+        # 远程更改打印机名和配置文件
+        data = mes["data"]
+        # 远程更改打印机名
+        if "printer_name" in data:
+            printer_name = mes["data"]["printer_name"]
+            self.plugin._settings.set(['printer_name'], printer_name)
+            self.plugin._settings.save()
+            self.plugin.send_event("ChangeName", printer_name)
+            _logger.info("Change printer name success, new name: %s" % printer_name)
+        # 远程更改配置文件
+        if "profile" in data:
+            profile = mes["data"]["profile"]
+            self.printer_manager.change_printer_profile(profile)
+            self.plugin.send_event("ChangeProfile")
+            _logger.info("Change current profile %s" % profile)
+        self.printer_info.invalidate()
 
     def flash_token(self, machine_id):
         sign, timestamp = self.get_sign(machine_id)
@@ -571,7 +668,7 @@ class CloudTask(object):
         body = {"machine_id": machine_id, "timestamp": timestamp, "sign": sign, "content": content}
         headers = {"content-type": "application/json"}
         url = "https://api.raise3d.com/octoprod-v1.1/user/getToken"
-        result = requests.post(url=url, data=json.dumps(body), headers=headers)
+        result = cloud_client().post(url, data=json.dumps(body), headers=headers)
         if result.status_code == 200:
             data = json.loads(result.content)
             token = data["data"]["token"]
@@ -611,7 +708,19 @@ class CloudTask(object):
             }
 
             # _logger.info("notify start print local file: {}".format(notify_data))
-            self.websocket.send_text(notify_data)
+            self._send_ws_data(notify_data)
+
+
+class TelemetryCallback(PrinterCallback):
+
+    def __init__(self, cloud_task):
+        self.cloud_task = cloud_task
+
+    def on_printer_add_temperature(self, data):
+        self.cloud_task.request_push()
+
+    def on_printer_send_current_data(self, data):
+        self.cloud_task.request_push()
 
 
 def hex_2_str(hex_str):
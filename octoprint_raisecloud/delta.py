@@ -0,0 +1,163 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+import json
+import time
+import numbers
+
+
+class FieldRule(object):
+    """
+    单个字段的增量发送规则
+    abs_deadband: 与上次发送值相差小于该值时不发送
+    rel_deadband: 与上次发送值的相对变化小于该比例时不发送
+    hysteresis: 变化方向与上次相反时，额外需要超过的差值（用于过滤温度抖动）
+    round_to: 比较和发送前按该步长取整
+    min_interval: 两次发送之间的最小间隔（秒），数值变为非数值（或反之）以及打印状态变化时不受限制
+    always: 每一帧都携带该字段
+    """
+
+    def __init__(self, abs_deadband=0, rel_deadband=0, hysteresis=0, round_to=None, min_interval=0, always=False):
+        self.abs_deadband = abs_deadband
+        self.rel_deadband = rel_deadband
+        self.hysteresis = hysteresis
+        self.round_to = round_to
+        self.min_interval = min_interval
+        self.always = always
+
+    def normalize(self, value):
+        if not self.round_to:
+            return value
+        number = to_number(value)
+        if number is None:
+            return value
+        rounded = round(number / self.round_to) * self.round_to
+        if isinstance(value, numbers.Integral):
+            return int(rounded)
+        if isinstance(value, numbers.Number):
+            return rounded
+        return '%.2f' % rounded
+
+    def suppress(self, value, last_value, last_direction, last_time, now, state_changed=False):
+        """
+        :return: 抑制该变化的规则名，None 表示需要发送
+        """
+        new, old = to_number(value), to_number(last_value)
+        if new is None or old is None:
+            return None
+        if self.min_interval and not state_changed and now - last_time < self.min_interval:
+            return "min_interval"
+        delta = new - old
+        if self.abs_deadband and abs(delta) < self.abs_deadband:
+            return "abs_deadband"
+        if self.rel_deadband and old and abs(delta) < abs(old) * self.rel_deadband:
+            return "rel_deadband"
+        if self.hysteresis and last_direction and direction(delta) != last_direction and \
+                abs(delta) < self.abs_deadband + self.hysteresis:
+            return "hysteresis"
+        return None
+
+
+_temperature_rule = FieldRule(abs_deadband=1, hysteresis=1)
+
+DEFAULT_RULES = {
+    "cur_print_state": FieldRule(always=True),
+    "machine_id": FieldRule(always=True),
+    "nozzle_temp_1": _temperature_rule,
+    "nozzle_temp_2": _temperature_rule,
+    "bed_temp": _temperature_rule,
+    "print_progress": FieldRule(round_to=1),
+    "left_time": FieldRule(min_interval=30),
+    "print_time_count": FieldRule(min_interval=30),
+    "storage_avl_kb": FieldRule(abs_deadband=1024),  # 变化小于1M
+}
+
+
+class DeltaEngine(object):
+    """
+    根据字段规则计算需要上报的增量数据，并统计每个字段的规则节省的帧数和字节数
+    """
+
+    def __init__(self, rules=None):
+        self.rules = DEFAULT_RULES if rules is None else rules
+        self.default_rule = FieldRule()
+        self.sent = dict()
+        self.sent_time = dict()
+        self.sent_direction = dict()
+        self.frames = 0
+        self.saved = dict()
+
+    def reset(self):
+        # 下一帧发送全量数据
+        self.sent = dict()
+        self.sent_time = dict()
+        self.sent_direction = dict()
+
+    def stats(self):
+        return {"frames": self.frames, "saved": dict((key, dict(value)) for key, value in self.saved.items())}
+
+    def diff(self, data, now=None):
+        """
+        :return: 需要发送的数据，没有变化时返回 None
+        """
+        now = time.time() if now is None else now
+        full = not self.sent
+        state_changed = "cur_print_state" in data and data["cur_print_state"] != self.sent.get("cur_print_state")
+        frame = dict()
+        suppressed = dict()
+        for key, value in data.items():
+            rule = self.rules.get(key, self.default_rule)
+            value = rule.normalize(value)
+            if full or key not in self.sent:
+                frame[key] = value
+                continue
+            last_value = self.sent[key]
+            if value == last_value:
+                continue
+            reason = rule.suppress(value, last_value, self.sent_direction.get(key),
+                                   self.sent_time.get(key, 0), now, state_changed)
+            if reason:
+                suppressed[key] = (reason, value)
+            else:
+                frame[key] = value
+
+        if frame:
+            for key, value in data.items():
+                if key not in frame and self.rules.get(key, self.default_rule).always:
+                    frame[key] = value
+            self._record(frame, now)
+            self.frames += 1
+
+        for key, (reason, value) in suppressed.items():
+            counter = self.saved.setdefault(key, {"rule": reason, "frames": 0, "bytes": 0})
+            counter["rule"] = reason
+            counter["bytes"] += len(json.dumps({key: value}))
+            if not frame:
+                counter["frames"] += 1
+        return frame or None
+
+    def _record(self, frame, now):
+        for key, value in frame.items():
+            delta = None
+            if key in self.sent:
+                new, old = to_number(value), to_number(self.sent[key])
+                if new is not None and old is not None:
+                    delta = new - old
+            if delta:
+                self.sent_direction[key] = direction(delta)
+            self.sent[key] = value
+            self.sent_time[key] = now
+
+
+def to_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, numbers.Number):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def direction(delta):
+    return 1 if delta > 0 else -1
@@ -0,0 +1,125 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+import time
+import logging
+import threading
+# Python2/3 compatible import
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_logger = logging.getLogger('octoprint.plugins.raisecloud')
+
+# 耗时直方图的分桶上限（毫秒），最后一个桶记录超过 5s 的消息
+HISTOGRAM_BUCKETS = (10, 50, 100, 250, 500, 1000, 5000)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def to_dict(self):
+        count = sum(self.counts)
+        buckets = dict(("<={}ms".format(bound), c) for bound, c in zip(HISTOGRAM_BUCKETS, self.counts))
+        buckets[">{}ms".format(HISTOGRAM_BUCKETS[-1])] = self.counts[-1]
+        return {
+            "count": count,
+            "avg_ms": int(self.total / count) if count else 0,
+            "max_ms": int(self.max),
+            "buckets": buckets
+        }
+
+
+class Lane(object):
+    """
+    一个工作线程按顺序执行同一类消息，慢消息不会阻塞其它类别
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="raisecloud-{}".format(self.name))
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put(job)
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                job()
+            except Exception as e:
+                _logger.error("Raisecloud {} lane error ...".format(self.name))
+                _logger.error(e)
+
+
+class CommandDispatcher(object):
+    """
+    按 message_type 分发云端消息到各自的工作线程，并记录每种消息从接收到处理完成的耗时
+    """
+
+    def __init__(self):
+        self.handlers = dict()
+        self.lanes = dict()
+        self.histograms = dict()
+        self._lock = threading.Lock()
+
+    def register(self, message_type, handler, lane):
+        if lane not in self.lanes:
+            self.lanes[lane] = Lane(lane)
+        self.handlers[message_type] = (handler, self.lanes[lane])
+        self.histograms[message_type] = Histogram()
+
+    def dispatch(self, message):
+        message_type = message.get("message_type")
+        try:
+            message_type = int(message_type)
+        except (TypeError, ValueError):
+            pass
+        if message_type not in self.handlers:
+            _logger.info("Unknown message type from raisecloud: %s" % message_type)
+            return
+        handler, lane = self.handlers[message_type]
+        received = time.time()
+
+        def job():
+            try:
+                handler(message)
+            finally:
+                with self._lock:
+                    self.histograms[message_type].add((time.time() - received) * 1000)
+
+        lane.submit(job)
+
+    def stats(self):
+        with self._lock:
+            return dict((message_type, histogram.to_dict()) for message_type, histogram in self.histograms.items())
+
+    def stop(self):
+        for lane in self.lanes.values():
+            lane.stop()
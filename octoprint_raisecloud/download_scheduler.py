@@ -0,0 +1,166 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+_logger = logging.getLogger('octoprint.plugins.raisecloud')
+
+MIN_RATE = 32 * 1024  # 自适应限速的下限 32KB/s
+SERIAL_SLOWDOWN = 1.5  # 串口发送间隔超过基准的倍数时降速
+
+
+# singleton
+_instance = None
+
+
+def download_scheduler_instance(plugin):
+    global _instance
+    if _instance is None:
+        _instance = DownloadScheduler(plugin)
+    return _instance
+
+
+class DownloadScheduler(object):
+    """
+    下载调度：打印中按配置限速并降低下载线程的 IO 优先级，
+    串口发送间隔相对基准变大时成倍降低速率，恢复后逐步提升
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self._settings = plugin.get_settings()
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.time()
+        self._rate = None
+        self._last_adjust = 0
+        # 吞吐统计
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._last_consume = 0
+        self.throughput = 0.0  # bytes/s
+        # 串口发送间隔，基准在没有下载时统计
+        self._last_sent = None
+        self._gap_baseline = None
+        self._gap_download = None
+
+    def _printing(self):
+        printer = self.plugin._printer
+        return printer.is_printing() or printer.is_paused()
+
+    def _downloading(self, now):
+        return now - self._last_consume < 2
+
+    def limit(self):
+        """
+        :return: 当前允许的下载速率 bytes/s，None 表示不限速
+        """
+        if self._printing():
+            cap = self._settings.get_int(["download_limit_kbps_printing"]) * 1024
+            if cap <= 0:
+                return None
+            if self._rate is None or self._rate > cap:
+                self._rate = cap
+            return self._rate if self._settings.get_boolean(["download_adaptive"]) else cap
+        cap = self._settings.get_int(["download_limit_kbps"]) * 1024
+        return cap if cap > 0 else None
+
+    def consume(self, nbytes):
+        # 每读取一块数据调用一次，超过速率时在下载线程中等待
+        now = time.time()
+        with self._lock:
+            self._update_throughput(nbytes, now)
+            limit = self.limit()
+            if not limit:
+                return
+            self._adjust(now)
+            self._tokens = min(limit, self._tokens + (now - self._last) * limit)  # 最多积累 1s 的突发
+            self._last = now
+            self._tokens -= nbytes
+            wait = -self._tokens / limit if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def _update_throughput(self, nbytes, now):
+        self._last_consume = now
+        self._window_bytes += nbytes
+        elapsed = now - self._window_start
+        if elapsed >= 1:
+            self.throughput = self.throughput * 0.5 + self._window_bytes / elapsed * 0.5
+            self._window_start = now
+            self._window_bytes = 0
+
+    def _adjust(self, now):
+        # 每秒根据串口发送间隔调整一次速率（AIMD）
+        if self._rate is None or now - self._last_adjust < 1:
+            return
+        self._last_adjust = now
+        cap = self._settings.get_int(["download_limit_kbps_printing"]) * 1024
+        if self._gap_baseline and self._gap_download and self._gap_download > self._gap_baseline * SERIAL_SLOWDOWN:
+            self._rate = max(MIN_RATE, self._rate / 2)
+            _logger.debug("Serial send slowed down, download rate lowered to %s KB/s" % int(self._rate / 1024))
+        else:
+            self._rate = min(cap, self._rate + cap * 0.1)
+
+    def throughput_kbps(self):
+        if not self._downloading(time.time()):
+            return 0
+        return int(self.throughput / 1024)
+
+    def on_gcode_sent(self):
+        # 由 octoprint.comm.protocol.gcode.sent hook 调用，只记录发送间隔
+        now = time.time()
+        if self._last_sent is not None:
+            gap = now - self._last_sent
+            if gap < 5:  # 忽略暂停、加热等待
+                if self._downloading(now):
+                    self._gap_download = gap if self._gap_download is None else self._gap_download * 0.95 + gap * 0.05
+                else:
+                    self._gap_baseline = gap if self._gap_baseline is None else self._gap_baseline * 0.95 + gap * 0.05
+        self._last_sent = now
+
+    def should_sync(self):
+        # 打印中分段写入磁盘，避免大量脏页集中写入 SD 卡
+        return self._printing()
+
+    @contextmanager
+    def background_io(self):
+        """
+        打印中降低当前下载线程的 IO 优先级，结束后恢复
+        """
+        restore = None
+        if self._printing():
+            restore = lower_thread_priority()
+        try:
+            yield
+        finally:
+            if restore:
+                restore()
+
+
+def lower_thread_priority():
+    """
+    Linux 下 ioprio 可以按线程设置，当前线程改为 idle 级别
+    :return: 恢复原优先级的函数，不支持时返回 None
+    """
+    import psutil
+    get_native_id = getattr(threading, "get_native_id", None)  # Python 3.8+
+    if not get_native_id or not hasattr(psutil, "IOPRIO_CLASS_IDLE"):
+        return None
+    try:
+        thread = psutil.Process(get_native_id())
+        old_ionice = thread.ionice()
+        thread.ionice(psutil.IOPRIO_CLASS_IDLE)
+    except Exception as e:
+        _logger.debug("Lower download thread priority error: %s" % e)
+        return None
+
+    def restore():
+        try:
+            thread.ionice(old_ionice.ioclass, old_ionice.value)
+        except Exception as e:
+            _logger.debug("Restore download thread priority error: %s" % e)
+
+    return restore
@@ -0,0 +1,334 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict
+
+_logger = logging.getLogger('octoprint.plugins.raisecloud')
+
+
+class FolderIndex(object):
+    """
+    RaiseCloud-File 目录的文件大小索引，文件增删时增量更新，
+    总大小超过上限时在后台线程按最近打印时间清理到下限以下
+    """
+
+    def __init__(self, plugin, printer_manager):
+        self.plugin = plugin
+        self.printer_manager = printer_manager
+        self.folder = printer_manager.folder
+        self.files = dict()  # path in storage -> size
+        self.total = 0
+        self._loaded = False
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def _contains(self, path):
+        return path.startswith(self.folder + "/")
+
+    def _load(self):
+        # 只在第一次使用时遍历一次目录，之后由文件事件增量更新
+        files = dict()
+        folder = self.plugin._file_manager.path_on_disk("local", self.folder)
+        for root, dirs, names in os.walk(folder):
+            for name in names:
+                if name.startswith("."):
+                    continue  # 下载中的临时文件
+                abs_path = os.path.join(root, name)
+                path = "/".join([self.folder] + os.path.relpath(abs_path, folder).split(os.sep))
+                try:
+                    files[path] = os.path.getsize(abs_path)
+                except OSError:
+                    pass
+        with self._lock:
+            files.update(self.files)
+            self.files = files
+            self.total = sum(files.values())
+            self._loaded = True
+
+    def size(self):
+        """
+        :return: 目录总大小（字节）
+        """
+        if not self._loaded:
+            self._load()
+        return self.total
+
+    def on_file_added(self, path):
+        if not self._contains(path):
+            return
+        try:
+            size = os.path.getsize(self.plugin._file_manager.path_on_disk("local", path))
+        except OSError:
+            return
+        with self._lock:
+            self.total += size - self.files.get(path, 0)
+            self.files[path] = size
+        self.request_clean()
+
+    def on_file_removed(self, path):
+        with self._lock:
+            size = self.files.pop(path, None)
+            if size is not None:
+                self.total -= size
+
+    def on_folder_removed(self, path):
+        prefix = path.rstrip("/") + "/"
+        with self._lock:
+            for file_path in [p for p in self.files if p.startswith(prefix)]:
+                self.total -= self.files.pop(file_path)
+
+    def request_clean(self):
+        with self._lock:
+            if not self._stopped and not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopped:
+                return
+            try:
+                self.clean()
+            except Exception as e:
+                _logger.error("Clean RaiseCloud file error ...")
+                _logger.error(e)
+
+    def clean(self):
+        settings = self.plugin._settings
+        high = settings.get_int(["clean_high_watermark_mb"]) * 1024 * 1024
+        low = settings.get_int(["clean_low_watermark_mb"]) * 1024 * 1024
+        if self.size() < high:
+            return
+        protected = self._protected_files()
+        removed = 0
+        for path in self._eviction_order():
+            if self.total <= low:
+                break
+            if path in protected or self.printer_manager.is_busy("local", path):
+                _logger.info("Trying to delete a file that is currently in use: %s" % path)
+                continue
+            # deselect the file if it's currently selected
+            currentOrigin, currentPath = self.printer_manager.get_current_file()
+            if currentPath is not None and currentOrigin == "local" and path == currentPath:
+                self.plugin._printer.unselect_file()
+            self.plugin._file_manager.remove_file("local", path)
+            self.printer_manager.file_cache.remove_path(path)
+            self.on_file_removed(path)
+            removed += 1
+        if removed:
+            _logger.info("Clean RaiseCloud file success, %s files removed, folder size: %s MB" %
+                         (removed, self.total // 1024 // 1024))
+
+    def _eviction_order(self):
+        """
+        :return: 按最近一次打印时间排序的文件，从未打印过的按修改时间
+        """
+        with self._lock:
+            paths = list(self.files)
+        return sorted(paths, key=self._last_used)
+
+    def _last_used(self, path):
+        file_manager = self.plugin._file_manager
+        try:
+            metadata = file_manager.get_metadata("local", path) or {}
+            if metadata.get("history"):
+                return metadata["history"][-1]["timestamp"]
+            return os.path.getmtime(file_manager.path_on_disk("local", path))
+        except Exception:
+            return 0
+
+    def _protected_files(self):
+        # 本地队列中已预取的任务文件不清理
+        cloud_task = getattr(self.plugin, "cloud_task", None)
+        if cloud_task is None:
+            return set()
+        return set(job["file_path"] for job in list(cloud_task.job_queue.jobs) if job["file_path"])
+
+
+class ListingIndex(object):
+    """
+    远程文件浏览的目录列表缓存：每个目录只列一次并排好序（先文件夹后文件，按名称），
+    翻页直接切片，文件事件使所在目录及上级目录失效
+    """
+
+    def __init__(self, build, max_dirs=32):
+        self.build = build
+        self.max_dirs = max_dirs
+        self._listings = OrderedDict()  # dir path -> sorted details
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            listing = self._listings.pop(path, None)
+            if listing is not None:
+                self._listings[path] = listing  # 最近使用的放到最后
+                return listing
+            generation = self._generation
+        listing = self.build(path)
+        with self._lock:
+            # 列目录期间有文件变化时不缓存，下次重新读取
+            if generation == self._generation:
+                self._listings[path] = listing
+                while len(self._listings) > self.max_dirs:
+                    self._listings.popitem(last=False)
+        return listing
+
+    def invalidate(self, path, folder=False):
+        """
+        path: 发生变化的文件或文件夹，folder 为 True 时同时清除该文件夹及其子目录
+        """
+        path = path.strip("/")
+        parts = path.split("/")
+        dirty = set("/".join(parts[:i]) for i in range(len(parts)))
+        with self._lock:
+            self._generation += 1
+            for dir_path in list(self._listings):
+                if dir_path in dirty or (folder and (dir_path == path or dir_path.startswith(path + "/"))):
+                    del self._listings[dir_path]
+
+
+class SearchIndex(object):
+    """
+    local 存储的文件名搜索索引：显示名和文件名按三字符片段建立倒排索引，
+    不区分大小写的子串查询只检查候选文件，文件事件增量更新
+    """
+
+    def __init__(self, load, max_results=8):
+        self.load = load  # 返回 (path, detail) 的可迭代对象
+        self.max_results = max_results
+        self._entries = dict()  # path -> (detail, lower names)
+        self._trigrams = dict()  # trigram -> set of paths
+        self._loaded = False
+        self._pending = None  # 建立索引期间收到的文件事件，建立完成后补上
+        self._generation = 0
+        self._results = OrderedDict()  # 最近查询的结果，翻页时保持一致
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+
+    def active(self):
+        """
+        :return: 索引已建立或正在建立，文件事件需要更新索引
+        """
+        return self._loaded or self._pending is not None
+
+    def _ensure_loaded(self):
+        # 遍历存储时不持有索引锁，文件事件不会被阻塞
+        with self._load_lock:
+            if self._loaded:
+                return
+            with self._lock:
+                self._pending = []
+            index = SearchIndex(self.load)
+            try:
+                for path, detail in self.load():
+                    index._add(path, detail)
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                for args in self._pending:
+                    index._apply(*args)
+                self._entries, self._trigrams = index._entries, index._trigrams
+                self._pending = None
+                self._loaded = True
+
+    def _apply(self, path, detail=None, folder=False):
+        # detail 为 None 时删除
+        if detail is not None:
+            self._add(path, detail)
+            return
+        self._remove(path)
+        if folder:
+            for child in [p for p in self._entries if p.startswith(path + "/")]:
+                self._remove(child)
+
+    def _add(self, path, detail):
+        self._remove(path)
+        names = (detail["file_name"].lower(), detail["real_name"].lower())
+        self._entries[path] = (detail, names)
+        for trigram in set(t for name in names for t in trigrams(name)):
+            self._trigrams.setdefault(trigram, set()).add(path)
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return
+        for trigram in set(t for name in entry[1] for t in trigrams(name)):
+            paths = self._trigrams.get(trigram)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self._trigrams[trigram]
+
+    def add(self, path, detail):
+        self._update(path, detail)
+
+    def remove(self, path, folder=False):
+        self._update(path, None, folder)
+
+    def _update(self, path, detail, folder=False):
+        with self._lock:
+            if self._loaded:
+                self._apply(path, detail, folder)
+            elif self._pending is not None:
+                self._pending.append((path, detail, folder))
+            self._generation += 1
+
+    def search(self, folder, keyword, regex=False, limit=500):
+        """
+        在 folder 及其子目录中查找，先文件夹后文件，按路径排序
+        regex: 为 True 时 keyword 为正则表达式，否则为普通字符串
+        :return: 最多 limit 条结果，real_name 为相对 folder 的路径；正则表达式无效时抛出 re.error
+        """
+        key = (folder, keyword, bool(regex), limit)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[0] == self._generation:
+                return cached[1]
+        self._ensure_loaded()
+        prefix = folder + "/" if folder else ""
+        if regex:
+            pattern = re.compile(keyword, re.IGNORECASE)
+            match = lambda names: any(pattern.search(name) for name in names)
+        else:
+            keyword = keyword.lower()
+            match = lambda names: any(keyword in name for name in names)
+        with self._lock:
+            generation = self._generation
+            paths = self._candidates(keyword) if not regex else list(self._entries)
+            hits = [(self._entries[p][0], p) for p in paths if p.startswith(prefix) and match(self._entries[p][1])]
+        hits.sort(key=lambda x: (x[0]["file_type"] != "dir", x[1].lower()))
+        results = [dict(detail, real_name=path[len(prefix):]) for detail, path in hits[:limit]]
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = (generation, results)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return results
+
+    def _candidates(self, keyword):
+        # 少于三个字符时无法使用倒排索引，检查所有文件
+        keys = trigrams(keyword)
+        if not keys:
+            return list(self._entries)
+        sets = sorted((self._trigrams.get(t, set()) for t in keys), key=len)
+        return list(sets[0].intersection(*sets[1:]))
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
@@ -0,0 +1,122 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+# Python2/3 compatiabile import
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+_logger = logging.getLogger('octoprint.plugins.raisecloud')
+
+MAX_ENDPOINTS = 32  # 统计表的上限，超过后新接口归入 "other"
+
+
+def build_retry(retries, backoff):
+    # 只有 GET 在读取超时和 5xx 时重试；POST（登录、获取 token、上传截图）服务器可能已经处理，
+    # 只在连接未建立时重试
+    kwargs = dict(total=retries, connect=retries, read=retries, backoff_factor=backoff,
+                  status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+    try:
+        return Retry(allowed_methods=frozenset(["GET"]), **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=frozenset(["GET"]), **kwargs)
+
+
+class HttpClient(object):
+    """
+    共享的 HTTP 客户端：连接池复用 TCP/TLS 连接，默认超时，失败重试，并按接口统计耗时
+    URL 每次都不同的请求（如任务文件下载）通过 endpoint 参数归到同一个统计项
+    """
+
+    def __init__(self, pool_size=4, timeout=(10.0, 30.0), retries=2, backoff=0.5):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=build_retry(retries, backoff))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._stats = dict()
+        self._lock = threading.Lock()
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.time()
+        error = False
+        try:
+            return self.session.request(method, url, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self._record(endpoint or url, (time.time() - start) * 1000, error)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def _record(self, url, ms, error):
+        tmp = urlparse(url)
+        endpoint = "{}{}".format(tmp.netloc, tmp.path) if tmp.netloc else url
+        with self._lock:
+            if endpoint not in self._stats and len(self._stats) >= MAX_ENDPOINTS:
+                endpoint = "other"
+            stat = self._stats.setdefault(endpoint, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stat["count"] += 1
+            stat["total_ms"] += ms
+            stat["max_ms"] = max(stat["max_ms"], ms)
+            if error:
+                stat["errors"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict((endpoint, {"count": stat["count"], "errors": stat["errors"],
+                                    "avg_ms": int(stat["total_ms"] / stat["count"]), "max_ms": int(stat["max_ms"])})
+                        for endpoint, stat in self._stats.items())
+
+    def close(self):
+        self.session.close()
+
+
+_cloud_client = None
+_webcam_client = None
+_clients_lock = threading.Lock()
+
+
+def cloud_client():
+    # RaiseCloud 接口及任务文件下载
+    global _cloud_client
+    with _clients_lock:
+        if _cloud_client is None:
+            _cloud_client = HttpClient(pool_size=4, timeout=(10.0, 30.0), retries=2)
+        return _cloud_client
+
+
+def webcam_client():
+    # 本地摄像头截图，单独的连接池，超时更短且不重试
+    global _webcam_client
+    with _clients_lock:
+        if _webcam_client is None:
+            _webcam_client = HttpClient(pool_size=2, timeout=(3.0, 10.0), retries=0)
+        return _webcam_client
+
+
+def close_clients():
+    global _cloud_client, _webcam_client
+    with _clients_lock:
+        for client in (_cloud_client, _webcam_client):
+            if client is not None:
+                client.close()
+        _cloud_client = None
+        _webcam_client = None
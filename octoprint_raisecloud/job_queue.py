@@ -0,0 +1,169 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+import time
+import logging
+import threading
+
+_logger = logging.getLogger('octoprint.plugins.raisecloud')
+
+QUEUED = "queued"
+READY = "ready"
+
+
+class JobQueue(object):
+    """
+    本地任务队列：打印中收到的云端任务保存到数据库，后台预先下载下一个任务的文件，
+    当前任务完成并确认打印平台已清空后立即开始下一个任务
+    """
+
+    def __init__(self, plugin, printer_manager, sqlite_server, on_start, on_failed):
+        self.plugin = plugin
+        self.printer_manager = printer_manager
+        self.sqlite_server = sqlite_server
+        self.on_start = on_start
+        self.on_failed = on_failed
+        self.jobs = []
+        self.waiting_bed_clear = False
+        self._start_requested = False
+        self._stopped = False
+        self._wakeup = threading.Event()
+        self._lock = threading.RLock()
+        self._thread = None
+        self._load()
+
+    def _load(self):
+        rows = self.sqlite_server.fetchall('SELECT id, task_id, download_url, filename, state, file_path FROM job_queue ORDER BY id') or []
+        for row in rows:
+            job = dict(zip(("id", "task_id", "download_url", "filename", "state", "file_path"), row))
+            if job["state"] == READY and not self.plugin._file_manager.file_exists("local", job["file_path"]):
+                job["state"] = QUEUED
+                job["file_path"] = None
+            self.jobs.append(job)
+
+    def depth(self):
+        return len(self.jobs)
+
+    def enqueue(self, task_id, download_url, filename):
+        max_size = self.plugin._settings.get_int(["job_queue_size"])
+        with self._lock:
+            if any(job["task_id"] == task_id for job in self.jobs):
+                return True
+            if len(self.jobs) >= max_size:
+                return False
+            insert_sql = 'INSERT INTO job_queue (task_id, download_url, filename, state, file_path, created) values (?, ?, ?, ?, ?, ?)'
+            self.sqlite_server.insert(insert_sql, [(task_id, download_url, filename, QUEUED, None, time.time())])
+            res = self.sqlite_server.fetchone('SELECT id FROM job_queue WHERE task_id = ? ORDER BY id DESC', task_id)
+            self.jobs.append({"id": res[0] if res else None, "task_id": task_id, "download_url": download_url,
+                              "filename": filename, "state": QUEUED, "file_path": None})
+        _logger.info("Task %s queued, queue depth: %s" % (task_id, len(self.jobs)))
+        self.start()
+        self._wakeup.set()
+        return True
+
+    def _remove(self, job):
+        with self._lock:
+            if job in self.jobs:
+                self.jobs.remove(job)
+            self.sqlite_server.delete('DELETE FROM job_queue WHERE id = ? ', [(job["id"],)])
+
+    def resume(self):
+        # 重启或重新登录后继续处理队列，打印机空闲时和打印结束一样处理，上次打印的模型可能还在平台上
+        if not self.jobs:
+            return
+        printer = self.plugin._printer
+        if printer.is_printing() or printer.is_paused():
+            self.start()
+        else:
+            self.on_print_done()
+
+    def on_print_done(self):
+        # 打印完成、取消或失败
+        if not self.jobs:
+            return
+        if self.plugin._settings.get_boolean(["job_queue_auto_start"]):
+            self._request_start()
+        else:
+            self.waiting_bed_clear = True
+            self.start()  # 等待确认期间预取下一个任务
+            self.plugin.send_event("BedClear")
+            _logger.info("Print done, waiting for bed clear confirmation to start next task.")
+
+    def confirm_bed_clear(self):
+        self.waiting_bed_clear = False
+        if self.jobs:
+            self._request_start()
+            return True
+        return False
+
+    def _request_start(self):
+        self._start_requested = True
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        with self._lock:
+            if self._stopped or (self._thread and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                self._prefetch()
+                if self._start_requested and self._printer_ready():
+                    self._start_requested = False
+                    self._start_next()
+            except Exception as e:
+                _logger.error("Raisecloud job queue error ...")
+                _logger.error(e)
+            self._wakeup.wait(5 if self._start_requested else 30)
+            self._wakeup.clear()
+
+    def _printer_ready(self):
+        printer = self.plugin._printer
+        return printer.is_operational() and not printer.is_printing() and not printer.is_paused() and \
+            not self.printer_manager.downloading
+
+    def _prefetch(self):
+        # 只预取下一个要打印的任务，其余任务开始前再下载
+        job = self.jobs[0] if self.jobs else None
+        if job is None or job["state"] != QUEUED or self.printer_manager.downloading:
+            return
+        _logger.info("Prefetch queued task %s ..." % job["task_id"])
+        file_path = self.printer_manager.ingest(job["download_url"], job["filename"], cancelled=lambda: self._stopped)
+        if not file_path:
+            if not self._stopped:
+                _logger.info("Prefetch queued task %s failed." % job["task_id"])
+                self._remove(job)
+                self.on_failed(job["task_id"])
+            return
+        with self._lock:
+            job["state"] = READY
+            job["file_path"] = file_path
+            self.sqlite_server.update('UPDATE job_queue SET state = ?, file_path = ? WHERE id = ? ',
+                                      [(READY, file_path, job["id"])])
+        if self._start_requested:
+            self._wakeup.set()
+
+    def _start_next(self):
+        if not self.jobs:
+            return
+        job = self.jobs[0]
+        if job["state"] != READY:
+            # 文件还在下载，下载完成后再开始
+            self._start_requested = True
+            return
+        self._remove(job)
+        if not self.plugin._file_manager.file_exists("local", job["file_path"]):
+            _logger.info("Queued task %s file is missing." % job["task_id"])
+            self.on_failed(job["task_id"])
+            return
+        _logger.info("Start queued task %s" % job["task_id"])
+        self.on_start(job["task_id"], job["file_path"])
+        self._wakeup.set()  # 开始预取下一个任务
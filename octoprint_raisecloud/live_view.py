@@ -0,0 +1,168 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+import time
+import base64
+import logging
+import threading
+from .websocket_server import FRAME_TYPE
+
+_logger = logging.getLogger('octoprint.plugins.raisecloud')
+
+# 实时画面协议（与云端约定的草案）：
+#   云端 -> 插件  message_type 14  {"data": {"live_view": 1}}  开始或保持订阅，观看期间需定时重发；
+#                                  {"data": {"live_view": 0}}  停止
+#   插件 -> 云端  message_type 15  {"data": {"machine_id", "frame": base64 JPEG, "seq", "fps", "quality", "timestamp"}}
+# 超过 live_view_timeout 秒没有收到订阅消息时自动停止。
+LIVE_VIEW_TYPE = 14
+
+MIN_FPS = 0.2
+MIN_QUALITY = 30
+MAX_QUALITY = 80
+TARGET_LATENCY_MS = 500  # 发送队列延迟超过该值时降低帧率和质量
+
+thread_time = getattr(time, "thread_time", time.time)  # Python 3.7+ 统计当前线程的 CPU 时间
+
+
+class LiveView(object):
+    """
+    通过云端 websocket 推送实时画面：按发送队列延迟和实际上传速率调整帧率和 JPEG 质量（AIMD），
+    编码耗时限制在 CPU 预算以内
+    """
+
+    def __init__(self, plugin, webcam, send, metrics, message_base):
+        self.plugin = plugin
+        self.webcam = webcam
+        self.send = send
+        self.metrics = metrics  # 返回发送队列统计，未连接时返回 None
+        self.message_base = message_base  # 返回 machine_id 和 token
+        self.fps = 1.0
+        self.quality = MAX_QUALITY
+        self.frames = 0
+        self.dropped = 0  # 发送队列已满被拒绝的帧
+        self._keepalive = 0
+        self._stopped = True
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._last_metrics = None
+        self._last_metrics_time = 0
+
+    def on_message(self, mes):
+        if int(mes["data"].get("live_view", 1)):
+            self.subscribe()
+        else:
+            self.stop()
+
+    def subscribe(self):
+        self._keepalive = time.time()
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                if not self._stopped:
+                    return
+                self._thread.join()  # 上一次推送正在退出
+            _logger.info("Live view started.")
+            self._stopped = False
+            self.fps = 1.0
+            self.quality = MAX_QUALITY
+            self._last_metrics = None
+            self._thread = threading.Thread(target=self._run, name="raisecloud-live-view")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def _expired(self):
+        return time.time() - self._keepalive > self.plugin._settings.get_int(["live_view_timeout"])
+
+    def _run(self):
+        seq = 0
+        next_frame = 0
+        try:
+            while not self._stopped and not self._expired():
+                started = time.time()
+                if started < next_frame:
+                    # 每秒至少检查一次订阅是否过期
+                    self._wakeup.wait(min(next_frame - started, 1))
+                    self._wakeup.clear()
+                    continue
+                cpu_start = thread_time()
+                frame = self.webcam.live_frame(self.quality)
+                cpu = thread_time() - cpu_start
+                if not frame:
+                    next_frame = started + 1
+                    continue
+                seq += 1
+                if not self.send(self._frame_data(frame, seq)):
+                    if self.metrics() is None:
+                        # 云端连接断开
+                        break
+                    # 发送队列已满，帧被丢弃：降低帧率和质量后继续
+                    self.dropped += 1
+                    self._backoff()
+                    next_frame = started + 1.0 / self.fps
+                    continue
+                self.frames += 1
+                self._adapt(len(frame), cpu)
+                next_frame = started + 1.0 / self.fps
+        except Exception as e:
+            _logger.error("Live view error: %s" % e)
+        finally:
+            self._stopped = True
+            _logger.info("Live view stopped, %s frames sent." % self.frames)
+
+    def _frame_data(self, frame, seq):
+        base = self.message_base()
+        return {
+            "message_type": FRAME_TYPE,
+            "machine_id": base["machine_id"],
+            "token": base["token"],
+            "data": {
+                "machine_id": base["machine_id"],
+                "frame": base64.b64encode(frame).decode("ascii"),
+                "seq": seq,
+                "fps": round(self.fps, 2),
+                "quality": self.quality,
+                "timestamp": int(time.time() * 1000)
+            }
+        }
+
+    def _adapt(self, frame_size, cpu):
+        metrics = self.metrics()
+        if not metrics:
+            return
+        now = time.time()
+        last, last_time = self._last_metrics, self._last_metrics_time
+        self._last_metrics, self._last_metrics_time = metrics, now
+        if last is None:
+            return
+        # 上一帧未发出就被替换，或队列延迟过高，说明上行带宽不足
+        congested = metrics["latency_ms"] > TARGET_LATENCY_MS or metrics["frames_replaced"] > last["frames_replaced"]
+        max_fps = float(self.plugin._settings.get_int(["live_view_max_fps"]))
+        if congested:
+            self._backoff()
+            # 拥塞时实际发送速率接近可用带宽，帧率不超过其 80%
+            rate = (metrics["bytes_sent"] - last["bytes_sent"]) / max(now - last_time, 0.001)
+            if rate > 0:
+                self.fps = max(MIN_FPS, min(self.fps, rate * 0.8 / (frame_size * 4 / 3.0)))
+        else:
+            self.fps = min(max_fps, self.fps + 0.5)
+            self.quality = min(MAX_QUALITY, self.quality + 5)
+        # 编码耗时不超过 CPU 预算，这是硬性上限
+        budget = self.plugin._settings.get_int(["live_view_cpu_budget"]) / 100.0
+        if cpu > 0:
+            self.fps = max(min(self.fps, budget / cpu), 0.05)
+
+    def _backoff(self):
+        self.fps = max(MIN_FPS, self.fps / 2)
+        self.quality = max(MIN_QUALITY, self.quality - 10)
+
+    def stats(self):
+        return {
+            "active": not self._stopped,
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "fps": round(self.fps, 2),
+            "quality": self.quality
+        }
@@ -4,26 +4,41 @@ import os
 import re
 import time
 import socket
-import requests
+import threading
 # Python2/3 compatiabile import
 try:
     from urllib.parse import urlparse
 except ImportError:
     from urlparse import urlparse
-import tarfile
+import hashlib
 import logging
-import psutil
+import tempfile
+from contextlib import closing, contextmanager
 import octoprint.filemanager.util
 from octoprint.util import dict_merge
+from octoprint.events import Events
 from octoprint.printer.profile import InvalidProfileError, CouldNotOverwriteError, SaveError
+from .http_client import cloud_client, webcam_client
+from .download_scheduler import download_scheduler_instance
+from .sqlite_util import sqlite_server_instance, FileCache
+from .folder_index import FolderIndex, ListingIndex, SearchIndex
 
 _logger = logging.getLogger('octoprint.plugins.raisecloud')
 
+# 较新版本的 OctoPrint 才有移动事件
+MOVE_EVENTS = (getattr(Events, "FILE_MOVED", None), getattr(Events, "FOLDER_MOVED", None))
+DOWNLOAD_ENDPOINT = "job file download"  # 下载地址每个任务都不同，HTTP 统计归到同一项
+
 
 class PrinterInfo(object):
     def __init__(self, plugin):
         self.plugin = plugin
         self._settings = plugin.get_settings()
+        # 不常变化的信息（配置文件、摄像头、名称、机型）缓存，事件触发时失效
+        self._static = None
+
+    def invalidate(self):
+        self._static = None
 
     @staticmethod
     def hex_2_str(unicde_str):
@@ -102,13 +117,14 @@ class PrinterInfo(object):
             _logger.error("Get printer job error ...")
             return job_info
 
-    def printer_temperature(self):
+    def printer_temperature(self, nozzle_num=None):
         """
         :return: {}
         nozzle_num nozzle_temp_1 bed_temp
         nozzle_temp_1_goal  bed_temp_goal
         """
-        nozzle_num = self._profile()["extruder"]["count"]
+        if nozzle_num is None:
+            nozzle_num = self._profile()["extruder"]["count"]
         temperature_info = {
             "nozzle_num": nozzle_num,
             "nozzle_temp_1": "",
@@ -140,7 +156,7 @@ class PrinterInfo(object):
     def _profile(self):
         return self.plugin._printer_profile_manager.get_current_or_default()
 
-    def printer_profile(self):
+    def printer_profile(self, data=None):
         """
         :return: {}
         machine_dim_x machine_dim_y machine_dim_z
@@ -153,13 +169,14 @@ class PrinterInfo(object):
             "nozzle_size_1": "",
         }
         try:
-            data = self._profile()
+            if data is None:
+                data = self._profile()
             if data:
                 volume_and_nozzle_info["machine_dim_x"] = int(data["volume"]["width"])
                 volume_and_nozzle_info["machine_dim_y"] = int(data["volume"]["depth"])
                 volume_and_nozzle_info["machine_dim_z"] = int(data["volume"]["height"])
                 volume_and_nozzle_info["nozzle_size_1"] = data["extruder"]["nozzleDiameter"]
-                if self._profile()["extruder"]["count"] == 2:
+                if data["extruder"]["count"] == 2:
                     volume_and_nozzle_info["nozzle_size_2"] = data["extruder"]["nozzleDiameter"]
             return volume_and_nozzle_info
         except Exception as e:
@@ -201,22 +218,7 @@ class PrinterInfo(object):
         storage_avl_kb
         storage_total_kb
         """
-        storage = {
-            "storage_avl_kb": "",
-            "storage_total_kb": ""
-        }
-        try:
-            storage_address = self._settings.getBaseFolder("uploads", check_writable=False)
-            usage = psutil.disk_usage(storage_address)
-            free = usage.free
-            total = usage.total
-            storage["storage_avl_kb"] = int(int(free) / 1024)
-            storage["storage_total_kb"] = int(int(total) / 1024)
-            return storage
-        except Exception as e:
-            _logger.error(e)
-            _logger.error("Get storage error ...")
-            return storage
+        return storage_sampler_instance(self.plugin).get()
 
     def printer_name(self):
         """
@@ -251,22 +253,103 @@ class PrinterInfo(object):
             result.update(dictionary)
         return result
 
+    def _static_info(self):
+        static = self._static
+        if static is None:
+            profile = self._profile()
+            static = {
+                "nozzle_num": profile["extruder"]["count"],
+                "info": self.merge_dicts(self.printer_profile(profile), self.printer_webcam(),
+                                         self.printer_name(), self.machine_type())
+            }
+            self._static = static
+        return static
+
     def get_printer_info(self):
-        return self.merge_dicts(self.printer_state(), self.job_file(), self.printer_temperature(),
-                                self.printer_profile(), self.printer_webcam(),
-                                self.printer_storage(), self.printer_name(), self.machine_type())
+        static = self._static_info()
+        return self.merge_dicts(self.printer_state(), self.job_file(), self.printer_temperature(static["nozzle_num"]),
+                                static["info"], self.printer_storage())
 
 
 def get_cam_status(camera_url, snapshot_url):
     if snapshot_url and camera_url:
         try:
-            result = requests.get(snapshot_url)
+            result = webcam_client().get(snapshot_url)
             if result.status_code == 200:
                 return True
         except:
             return False
 
 
+# singleton
+_instance_sampler = None
+
+
+def storage_sampler_instance(plugin):
+    global _instance_sampler
+    if _instance_sampler is None:
+        _instance_sampler = StorageSampler(plugin)
+    return _instance_sampler
+
+
+class StorageSampler(object):
+    """
+    在后台线程中定时采样上传目录所在磁盘的使用情况，状态上报只读取最近一次的采样结果
+    """
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self._settings = plugin.get_settings()
+        self.storage = {
+            "storage_avl_kb": "",
+            "storage_total_kb": ""
+        }
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._stopped or (self._thread and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def trigger(self):
+        # 文件增删后立即重新采样
+        self.start()
+        self._wakeup.set()
+
+    def get(self):
+        self.start()
+        return self.storage
+
+    def _run(self):
+        while not self._stopped:
+            self.sample()
+            self._wakeup.wait(self._settings.get_int(["storage_sample_interval"]))
+            self._wakeup.clear()
+
+    def sample(self):
+        try:
+            storage_address = self._settings.getBaseFolder("uploads", check_writable=False)
+            import psutil
+            usage = psutil.disk_usage(storage_address)
+            self.storage = {
+                "storage_avl_kb": int(int(usage.free) / 1024),
+                "storage_total_kb": int(int(usage.total) / 1024)
+            }
+        except Exception as e:
+            _logger.error(e)
+            _logger.error("Get storage error ...")
+
+
 # singleton
 _instance = None
 
@@ -281,13 +364,15 @@ def printer_manager_instance(plugin):
 class PrinterManager(object):
     def __init__(self, plugin):
         self.plugin = plugin
-        self.zip_url = os.path.join(self.plugin.get_plugin_data_folder(), "compress")
-        self.unzip_url = os.path.join(self.plugin.get_plugin_data_folder(), "uncompress")
         self.downloading = False
         self.task_id = "not_remote_tasks"
         self.cancel = False
         self.manual = False
         self.folder = "RaiseCloud-File"
+        self.file_cache = FileCache(sqlite_server_instance(plugin))
+        self.folder_index = FolderIndex(plugin, self)
+        self.listing_index = ListingIndex(self.list_dir)
+        self.search_index = SearchIndex(self.walk_storage)
 
     def change_printer_profile(self, new_profile):
         """
@@ -312,80 +397,95 @@ class PrinterManager(object):
             return False
         return True
 
-    def get_files(self, path, keyword=None, start=0, length=5):
-        # 之前传的是以/local开头的绝对路径
-        if path == "/local":
-            path = ""
+    def get_files(self, path, keyword=None, start=0, length=5, regex=False):
+        # 之前传的是以/local开头的绝对路径，去掉前缀和首尾的 / 后作为缓存和搜索的键
+        if path == "/local" or path.startswith("/local/"):
+            path = path[len("/local"):]
+        path = path.strip("/")
+
+        if keyword:
+            # filter 关键字过滤查询, 不区分大小写，支持中文，包含子目录
+            try:
+                final_list = self.search_index.search(path, keyword, regex=regex,
+                                                      limit=self.plugin._settings.get_int(["search_match_limit"]))
+            except re.error as e:
+                _logger.info("Invalid search pattern %s: %s" % (keyword, e))
+                final_list = []
         else:
-            path = path.replace("/local/", "")
+            # 所有文件排序， 先文件夹，后文件，按字母顺序排
+            final_list = self.listing_index.get(path)
 
+        file_list_count = len(final_list)
+        # 根据 start length 返回数据   0-5   5-10   10-15
+        return_data = final_list[start: start + length]
+
+        result_data = {
+            "file_list_count": file_list_count,
+            "start": start,
+            "file_list": return_data
+        }
+        return result_data
+
+    def list_dir(self, path):
+        """
+        :return: 目录下的文件夹和文件，先文件夹后文件，分别按名称排序
+        """
         data = self.plugin._file_manager.list_files(path=path, filter=None, recursive=False)
         # 获取dir_path下所有文件列表
         if not data:
-            return {
-                "file_list_count": 0,
-                "start": start,
-                "file_list": []
-            }
+            return []
 
-        # 所有文件排序， 先文件夹，后文件，按字母顺序排
-        final_list = []
         dir_sort_list = []
         file_sort_list = []
         for content_data in data["local"].values():
-            detail = {
-                "file_type": "dir" if content_data["typePath"][0] == "folder" else "file",
-                "file_name": content_data["display"],
-                "real_name": content_data["name"],
-                "last_modified_time": timestamp_2_str(content_data["date"]) if "date" in content_data else "",
-                "file_size": content_data["size"] if "size" in content_data else ""
-            }
+            detail = file_detail(content_data)
             if detail["file_type"] == "dir":
                 dir_sort_list.append(detail)  # 文件夹
             else:
                 file_sort_list.append(detail)  # 文件
 
-        if dir_sort_list:
-            dir_sort_list.sort(key=lambda x: x["real_name"].lower())
-        if file_sort_list:
-            file_sort_list.sort(key=lambda x: x["real_name"].lower())
+        dir_sort_list.sort(key=lambda x: x["real_name"].lower())
+        file_sort_list.sort(key=lambda x: x["real_name"].lower())
+        return dir_sort_list + file_sort_list
 
-        # filter 关键字过滤查询, 不区分大小写，支持中文
-        if keyword:
-            if dir_sort_list:
-                for key1 in dir_sort_list:
-                    if re.search(keyword, key1["file_name"], re.IGNORECASE) or \
-                            re.search(keyword, key1["real_name"], re.IGNORECASE):
-                        final_list.append(key1)
-            if file_sort_list:
-                for key2 in file_sort_list:
-                    if re.search(keyword, key2["file_name"], re.IGNORECASE) or \
-                            re.search(keyword, key2["real_name"], re.IGNORECASE):
-                        final_list.append(key2)
-        else:
-            final_list.extend(dir_sort_list)
-            final_list.extend(file_sort_list)
-
-        file_list_count = len(final_list)
-        # 根据 start length 返回数据   0-5   5-10   10-15
-        return_data = final_list[start: start + length]
+    def walk_storage(self):
+        """
+        :return: local 存储中所有文件和文件夹的 (path, detail)
+        """
+        data = self.plugin._file_manager.list_files(path="", filter=None, recursive=True)
+        stack = [("", entry) for entry in ((data or {}).get("local") or {}).values()]
+        while stack:
+            parent, content_data = stack.pop()
+            path = parent + content_data["name"]
+            yield path, file_detail(content_data)
+            stack.extend((path + "/", child) for child in (content_data.get("children") or {}).values())
 
-        result_data = {
-            "file_list_count": file_list_count,
-            "start": start,
-            "file_list": return_data
+    def storage_detail(self, path, folder=False):
+        # 文件事件中没有显示名和大小，从元数据和磁盘读取
+        file_manager = self.plugin._file_manager
+        name = path.rsplit("/", 1)[-1]
+        metadata = {} if folder else (file_manager.get_metadata("local", path) or {})
+        stat = os.stat(file_manager.path_on_disk("local", path))
+        return {
+            "file_type": "dir" if folder else "file",
+            "file_name": metadata.get("display", name),
+            "real_name": name,
+            "last_modified_time": timestamp_2_str(stat.st_mtime),
+            "file_size": "" if folder else stat.st_size
         }
-        return result_data
 
-    def load_thread(self, download_url, filename, success_data, failed_data, websocket):
-        load_status = self.load_and_start(download_url, filename)
+    def load_thread(self, download_url, filename, success_data, failed_data, send, checksum=None):
+        try:
+            load_status = self.load_and_start(download_url, filename, checksum)
+        finally:
+            sqlite_server_instance(self.plugin).release()
         if load_status:
-            websocket.send_text(success_data)
+            send(success_data)
             # _logger.info("send a print start message to cloud: {}".format(success_data))
         else:
             # 下载文件失败
             if not self.manual:
-                websocket.send_text(failed_data)
+                send(failed_data)
                 # _logger.info("send download remote file error message to cloud: {}".format(failed_data))
             self.manual = False
             self.task_id = "not_remote_tasks"
@@ -398,15 +498,47 @@ class PrinterManager(object):
             return False
         return True
 
-    def load_and_start(self, download_url, filename):
-        self.downloading = True
+    def load_and_start(self, download_url, filename, checksum=None):
+        added_file = self.ingest(download_url, filename, checksum=checksum)
+        if not added_file:
+            return False
         try:
-            download_file_path = self.download_zip_file(download_url, self.zip_url, self.unzip_url)
-            self.downloading = False
+            absFilename = self.plugin._file_manager.path_on_disk("local", added_file)
+            self.plugin._printer.select_file(absFilename, sd=False, printAfterSelect=True)
+            return True
+        except Exception as e:
+            _logger.error("Load and select file for printing error ...")
+            _logger.error(e)
+            return False
+
+    def ingest(self, download_url, filename, cancelled=None, checksum=None):
+        """
+        下载并解压任务文件到 uploads/RaiseCloud-File，相同的压缩包已导入过时直接使用本地文件
+        cancelled: 后台预取时传入，返回 True 时取消下载；为 None 时为前台下载，可被云端取消
+        checksum: 云端下发的压缩包 MD5，没有时使用 ETag
+        :return: 文件在 local 存储中的路径，失败时返回 None
+        """
+        foreground = cancelled is None
+        if foreground:
+            self.downloading = True
+            cancelled = lambda: self.cancel
+        download_file_path = None
+        try:
+            cache_key = self.cache_key(download_url, checksum)
+            cached_file = self.cached_file(cache_key)
+            if cached_file:
+                _logger.info("Task file is already downloaded, use local file: %s" % cached_file)
+                return cached_file
+            self.check_folder_exists(create=True)
+            raisecloud_folder = self.plugin._file_manager.path_on_disk("local", self.folder)
+            with download_scheduler_instance(self.plugin).background_io():
+                download_file_path = self.download_zip_file(download_url, raisecloud_folder, cancelled)
+            if foreground:
+                self.downloading = False
             if download_file_path:
-                self.check_folder_exists(create=True)
+                # 临时文件与目标在同一目录，add_file 通过 rename 原子提交，不再复制
                 file_object = octoprint.filemanager.util.DiskFileWrapper(filename=filename,
-                                                                         path=download_file_path)
+                                                                         path=download_file_path, move=True)
                 canonPath, canonFilename = self.plugin._file_manager.canonicalize("local", filename)
                 futurePath = self.plugin._file_manager.sanitize_path("local", self.folder)  # uploads/Raisecloud-File
                 futureFilename = self.plugin._file_manager.sanitize_name("local", canonFilename)
@@ -417,21 +549,54 @@ class PrinterManager(object):
 
                 added_file = self.plugin._file_manager.add_file("local", futureFullPathInStorage, file_object,
                                                                 allow_overwrite=True, display=canonFilename)
-
-                absFilename = self.plugin._file_manager.path_on_disk("local", added_file)
-                self.plugin._printer.select_file(absFilename, sd=False, printAfterSelect=True)
-
-                return True
-            return False
+                if cache_key and added_file:
+                    stat = os.stat(self.plugin._file_manager.path_on_disk("local", added_file))
+                    self.file_cache.put(cache_key, added_file, stat.st_size, stat.st_mtime)
+                if added_file:
+                    self.folder_index.on_file_added(added_file)
+                return added_file
+            return None
         except Exception as e:
-            self.downloading = False
-            _logger.error("Load and select file for printing error ...")
+            _logger.error("Load file for printing error ...")
             _logger.error(e)
-            return False
+            return None
         finally:
-            # 清理解压文件
-            import shutil
-            shutil.rmtree(self.unzip_url)
+            if foreground:
+                self.downloading = False
+                self.cancel = False
+            # 清理未提交的临时文件
+            if download_file_path and os.path.exists(download_file_path):
+                os.remove(download_file_path)
+
+    def cache_key(self, download_url, checksum=None):
+        """
+        :return: 压缩包内容的标识，优先使用云端下发的 MD5，其次是强 ETag 和文件大小，都没有时不缓存
+        """
+        if checksum:
+            return "md5:{}".format(checksum.lower())
+        try:
+            info = probe_download(download_url)
+        except Exception as e:
+            _logger.info("Probe download file error: %s" % e)
+            return None
+        if info and info["etag"] and info["length"] is not None:
+            return "etag:{}:{}".format(info["etag"], info["length"])
+        return None
+
+    def cached_file(self, cache_key):
+        # 缓存的文件被删除或被覆盖（包括用户从界面上传同名文件）后失效，按大小和修改时间判断
+        if not cache_key:
+            return None
+        cached = self.file_cache.get(cache_key)
+        if not cached:
+            return None
+        file_path, size, mtime = cached
+        if mtime is not None and self.plugin._file_manager.file_exists("local", file_path):
+            stat = os.stat(self.plugin._file_manager.path_on_disk("local", file_path))
+            if stat.st_size == size and stat.st_mtime == mtime:
+                return file_path
+        self.file_cache.remove(cache_key)
+        return None
 
     def get_current_file(self):
         current_job = self.plugin._printer.get_current_job()
@@ -447,102 +612,450 @@ class PrinterManager(object):
 
         return any(target == x[0] and self.plugin._file_manager.file_in_path("local", path, x[1]) for x in self.plugin._file_manager.get_busy_files())
 
-    def clean_file(self):
-        # 文件不存在，不清理
-        if not self.check_folder_exists():
+    def on_storage_event(self, event, payload):
+        # local 存储的文件增删事件，更新文件大小索引、目录列表缓存和任务文件缓存
+        if event in MOVE_EVENTS:
+            # 移动时源和目标目录都失效，按删除后添加处理
+            self.on_storage_event(Events.FOLDER_REMOVED if event == MOVE_EVENTS[1] else Events.FILE_REMOVED,
+                                  {"path": payload["source_path"]})
+            self.on_storage_event(Events.FOLDER_ADDED if event == MOVE_EVENTS[1] else Events.FILE_ADDED,
+                                  {"path": payload["destination_path"]})
             return
-        clean_folder = self.plugin._file_manager.sanitize_path('local', self.folder)  # uploads/Raisecloud-File
-        size = get_dir_size(clean_folder)
-        if size >= 500:  # 500M
-            data = self.plugin._file_manager.list_files(path=self.folder, filter=None, recursive=False)
-            if not data:
-                return
-            clean_file_name = None
-            key = data["local"].keys()[0]
-            last_print_time = data["local"][key]["history"][-1]["timestamp"] if "history" in data["local"][key] else \
-                data["local"][key]["date"]
-            for detail in data["local"].values():
-                tmp_time = detail["history"][-1]["timestamp"] if "history" in detail else detail["date"]
-                if tmp_time <= last_print_time:
-                    clean_file_name = detail["name"]
-                    last_print_time = tmp_time
-            clean_file = os.path.join(self.folder + "/{}".format(clean_file_name))
-            # clean_file = os.path.join("Raisecloud-File", clean_file_name)
-
-            if self.is_busy("local", clean_file):
-                _logger.info("Trying to delete a file that is currently in use: %s" % clean_file)
-                return
-            # deselect the file if it's currently selected
-            currentOrigin, currentPath = self.get_current_file()
-            if currentPath is not None and currentOrigin == "local" and clean_file == currentPath:
-                self.plugin._printer.unselect_file()
-            self.plugin._file_manager.remove_file("local", clean_file)
-            _logger.info("Clean RaiseCloud file success.")
-
-    def download_zip_file(self, download_url, zip_url, unzip_url):
-        if not os.path.exists(unzip_url):
-            os.makedirs(unzip_url)
-        if not os.path.exists(zip_url):
-            os.makedirs(zip_url)
-        compress_path = os.path.join(zip_url, 'tmp.tar.gz')
-        gcode_name = ""
-
-        status = self.retry_download(3, download_url, compress_path)
-        self.cancel = False
-        if not status:
+        path = payload["path"]
+        folder = event in (Events.FOLDER_ADDED, Events.FOLDER_REMOVED)
+        self.listing_index.invalidate(path, folder=folder)
+        if event in (Events.FILE_ADDED, Events.FOLDER_ADDED):
+            try:
+                # 搜索索引还没有建立时不读取文件信息
+                if self.search_index.active():
+                    self.search_index.add(path, self.storage_detail(path, folder=folder))
+            except OSError:
+                pass
+            if event == Events.FILE_ADDED:
+                self.folder_index.on_file_added(path)
+            return
+        self.search_index.remove(path, folder=folder)
+        if event == Events.FILE_REMOVED:
+            self.folder_index.on_file_removed(path)
+        elif event == Events.FOLDER_REMOVED:
+            self.folder_index.on_folder_removed(path)
+        self.file_cache.remove_path(path)
+
+    def remove_stale_files(self):
+        # OctoPrint 在下载过程中退出时残留的临时文件，以及旧版本使用的下载目录
+        import shutil
+        raisecloud_folder = self.plugin._file_manager.path_on_disk("local", self.folder)
+        if os.path.isdir(raisecloud_folder):
+            for name in os.listdir(raisecloud_folder):
+                if not name.startswith(".raisecloud-"):
+                    continue
+                try:
+                    os.remove(os.path.join(raisecloud_folder, name))
+                    _logger.info("Remove stale download file: %s" % name)
+                except OSError as e:
+                    _logger.error("Remove stale download file error: %s" % e)
+        for name in ("compress", "uncompress"):
+            path = os.path.join(self.plugin.get_plugin_data_folder(), name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def clean_file(self):
+        # 在后台线程中按大小索引清理，不阻塞事件线程
+        self.folder_index.request_clean()
+
+    def download_zip_file(self, download_url, target_folder, cancelled, retry_times=3):
+        """
+        边下载边解压，gcode 直接写入 target_folder 下的临时文件，只写一次磁盘
+        :return: 临时文件路径，失败时返回 False
+        """
+        status = False
+        scheduler = download_scheduler_instance(self.plugin)
+        try:
+            segments = self.plugin._settings.get_int(["download_segments"]) or 1
+            if segments > 1 and not cancelled():
+                status = self.download_segmented(download_url, target_folder, cancelled, segments)
+            while not status and retry_times > 0 and not cancelled():
+                # 连接中断且无法续传时从头开始
+                reader = DownloadReader(download_url, cancelled, throttle=scheduler.consume)
+                status = self.extract_gcode(reader, target_folder)
+                if status or cancelled():
+                    break
+                retry_times -= 1
+                _logger.info("An error occurred, retry download.")
+        finally:
+            storage_sampler_instance(self.plugin).trigger()
+        if status:
+            _logger.info("Download file success. ")
+        else:
             _logger.info("Download file failed.")
-            return status
-        _logger.info("Download file success. ")
+        return status
+
+    def download_segmented(self, download_url, target_folder, cancelled, segments):
+        """
+        服务器支持 Range 时多连接并行下载压缩包到预分配的临时文件，校验后再解压
+        :return: gcode 临时文件路径，不支持分段或下载失败时返回 False，由单连接下载接管
+        """
+        scheduler = download_scheduler_instance(self.plugin)
+        download = SegmentedDownload(download_url, cancelled, segments, throttle=scheduler.consume,
+                                     background_io=scheduler.background_io)
+        fd, archive_path = tempfile.mkstemp(prefix=".raisecloud-", suffix=".part", dir=target_folder)
+        os.close(fd)
         try:
-            tar = tarfile.open(compress_path, "r:gz")
-            download_file_names = tar.getnames()
-            for value in download_file_names:
-                if str(value).endswith(".gcode"):
-                    gcode_name = str(value)
-            tar.extract(gcode_name, unzip_url)
-            tar.close()
-
-            download_path = os.path.join(unzip_url, gcode_name)
-            return download_path
+            if not download.run(archive_path):
+                return False
+            with open(archive_path, "rb") as archive:
+                return self.extract_gcode(archive, target_folder)
         except Exception as e:
-            _logger.error("Open file error.")
-            _logger.error(e)
+            _logger.error("Segmented download error, fall back to single connection: %s" % e)
             return False
         finally:
-            # 清理压缩文件
-            os.remove(compress_path)
+            if os.path.exists(archive_path):
+                os.remove(archive_path)
 
-    def retry_download(self, retry_times, download_url, compress_path):
-        # retry 上行retry消息
-        status = False
-        if self.cancel:
+    def extract_gcode(self, reader, target_folder):
+        import tarfile
+        tmp_path = None
+        try:
+            with closing(reader), tarfile.open(fileobj=reader, mode="r|gz") as tar:
+                for member in tar:
+                    if not (member.isfile() and str(member.name).endswith(".gcode")):
+                        continue
+                    # 以 . 开头的临时文件不会出现在 OctoPrint 的文件列表中
+                    fd, tmp_path = tempfile.mkstemp(prefix=".raisecloud-", suffix=".tmp", dir=target_folder)
+                    with os.fdopen(fd, "wb") as gcode_file:
+                        self._write_paced(tar.extractfile(member), gcode_file)
+                    return tmp_path
+            _logger.error("No gcode file in download archive.")
             return False
-        while retry_times > 0:
-            status = self.retry(download_url, compress_path)
-            if status:
-                break
-            if self.cancel:
+        except Exception as e:
+            _logger.error("Download and extract file error.")
+            _logger.error(e)
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+
+    def _write_paced(self, source, target, sync_size=4 * 1024 * 1024):
+        # 打印中每写入 4M 同步一次磁盘，避免大量脏页集中写入阻塞串口发送
+        scheduler = download_scheduler_instance(self.plugin)
+        unsynced = 0
+        while True:
+            chunk = source.read(100000)
+            if not chunk:
                 break
-            retry_times -= 1
-            _logger.info("An error occurred, retry download.")
-        return status
+            target.write(chunk)
+            unsynced += len(chunk)
+            if unsynced >= sync_size and scheduler.should_sync():
+                target.flush()
+                os.fsync(target.fileno())
+                unsynced = 0
+        target.flush()
+        os.fsync(target.fileno())
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class DownloadReader(object):
+    """
+    以文件对象的方式读取下载流，连接中断时用 Range 请求从已读取的位置继续
+    """
 
-    def retry(self, download_url, compress_path):
+    def __init__(self, download_url, cancelled, throttle=None, retry_times=3, chunk_size=100000):
+        self.cancelled = cancelled
+        self.throttle = throttle
+        self.download_url = download_url
+        self.retry_times = retry_times
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.validator = dict()
+        self._response = None
+        self._chunks = None
+        self._chunk = b""
+        self._pos = 0
+
+    def _open(self):
+        headers = dict()
+        if self.offset:
+            if not self.validator.get("resumable"):
+                raise IOError("Download interrupted, server does not support resume")
+            headers["Range"] = "bytes={}-".format(self.offset)
+            headers["If-Range"] = self.validator["etag"] or self.validator["last_modified"]
+        r = cloud_client().get(self.download_url, stream=True, timeout=(10.0, 60.0), endpoint=DOWNLOAD_ENDPOINT,
+                               headers=headers)
+        if self.offset:
+            if r.status_code != 206 or content_range(r) != (self.offset, self.validator["length"]):
+                r.close()
+                raise IOError("Resume download rejected, status: %s" % r.status_code)
+        elif r.status_code != 200:
+            r.close()
+            raise IOError("Download file response status: %s" % r.status_code)
+        else:
+            self.validator = response_validator(r)
+        self._response = r
+        self._chunks = r.iter_content(chunk_size=self.chunk_size)
+
+    def _next_chunk(self):
+        # 每次成功读取数据后重试次数重新计算，只有没有进展的失败才消耗重试次数
+        retry_times = self.retry_times
+        while True:
+            if self.cancelled():
+                raise DownloadCancelled()
+            try:
+                if self._chunks is None:
+                    self._open()
+                chunk = next(self._chunks, b"")
+                if chunk:
+                    self.offset += len(chunk)
+                    if self.throttle:
+                        self.throttle(len(chunk))
+                    return chunk
+                length = self.validator.get("length")
+                if length is not None and self.offset != length:
+                    raise IOError("Download file incomplete.")
+                return b""
+            except DownloadCancelled:
+                raise
+            except Exception as e:
+                self.close()
+                retry_times -= 1
+                if retry_times <= 0 or (self.offset and not self.validator.get("resumable")):
+                    raise
+                _logger.info("Download interrupted at %s bytes, resume download: %s" % (self.offset, e))
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = [self._chunk[self._pos:]]
+            self._chunk, self._pos = b"", 0
+            chunk = self._next_chunk()
+            while chunk:
+                data.append(chunk)
+                chunk = self._next_chunk()
+            return b"".join(data)
+        if self._pos >= len(self._chunk):
+            self._chunk = self._next_chunk()
+            self._pos = 0
+        data = self._chunk[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+        self._response = None
+        self._chunks = None
+
+
+class SegmentedDownload(object):
+    """
+    多连接分段下载：按 Range 把文件分成若干段并行写入预分配的文件，每段单独续传重试，
+    所有请求都带 If-Range，文件在服务器上变化时放弃分段下载
+    """
+    MAX_SEGMENTS = 4  # 与 cloud_client 连接池大小一致
+    MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, download_url, cancelled, segments, throttle=None, background_io=None, retry_times=3,
+                 chunk_size=100000):
+        self.download_url = download_url
+        self.cancelled = cancelled
+        self.segments = min(segments, self.MAX_SEGMENTS)
+        self.throttle = throttle
+        self.background_io = background_io
+        self.retry_times = retry_times
+        self.chunk_size = chunk_size
+        self.length = None
+        self.etag = None
+        self.validator = None
+        self.md5 = None
+        self.error = None
+        self._failed = threading.Event()
+
+    def probe(self):
+        # 服务器支持 Range 且带强校验信息时才分段下载
+        info = probe_download(self.download_url)
+        if not info or not info["ranges"] or not (info["etag"] or info["last_modified"]):
+            return False
+        self.length = info["length"]
+        self.etag = info["etag"]
+        self.validator = info["etag"] or info["last_modified"]
+        self.md5 = info["md5"]
+        return True
+
+    def split(self):
+        count = max(1, min(self.segments, self.length // self.MIN_SEGMENT_SIZE))
+        size = -(-self.length // count)
+        return [{"start": start, "end": min(start + size, self.length) - 1, "done": 0}
+                for start in range(0, self.length, size)]
+
+    def run(self, path):
+        """
+        :return: True 下载完成并通过校验；False 服务器不支持分段或文件太小
+        """
+        if not self.probe():
+            _logger.info("Server does not support range requests, use single connection download.")
+            return False
+        segments = self.split()
+        if len(segments) < 2:
+            return False
+        started = time.time()
+        preallocate(path, self.length)
+        threads = []
+        for segment in segments:
+            thread = threading.Thread(target=self._fetch, args=(path, segment))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if self.cancelled():
+            raise DownloadCancelled()
+        if self._failed.is_set():
+            raise self.error
+        self.verify(path, segments)
+        elapsed = max(time.time() - started, 0.001)
+        _logger.info("Segmented download finished: %s bytes, %s connections, %s KB/s" %
+                     (self.length, len(segments), int(self.length / elapsed / 1024)))
+        return True
+
+    def _fetch(self, path, segment):
+        # 每段单独重试，有进展时重试次数重新计算
+        retry_times = self.retry_times
         try:
-            r = requests.get(download_url, stream=True, timeout=(10.0, 60.0))
-            if r.status_code == 200:
-                with open(compress_path, "wb") as compress_file:
-                    for chunk in r.iter_content(chunk_size=100000):  # 100kb
-                        if self.cancel:
-                            # os.remove(compress_path)
-                            return False
-                        compress_file.write(chunk)
-            return True
+            with (self.background_io or _no_op)(), open(path, "r+b") as target:
+                while not self._finished(segment):
+                    done = segment["done"]
+                    try:
+                        self._fetch_range(target, segment)
+                    except DownloadCancelled:
+                        return
+                    except Exception as e:
+                        retry_times = self.retry_times if segment["done"] > done else retry_times - 1
+                        if retry_times <= 0:
+                            raise
+                        _logger.info("Segment %s-%s interrupted at %s bytes, retry: %s" %
+                                     (segment["start"], segment["end"], segment["done"], e))
         except Exception as e:
-            _logger.info("Download file from remote error.")
-            _logger.error(e)
-            # os.remove(compress_path)
-            return False
+            self.error = e
+            self._failed.set()
+
+    def _finished(self, segment):
+        return segment["done"] >= segment["end"] - segment["start"] + 1
+
+    def _fetch_range(self, target, segment):
+        start = segment["start"] + segment["done"]
+        headers = {"Range": "bytes={}-{}".format(start, segment["end"]), "If-Range": self.validator}
+        with closing(cloud_client().get(self.download_url, stream=True, timeout=(10.0, 60.0),
+                                        endpoint=DOWNLOAD_ENDPOINT, headers=headers)) as r:
+            if r.status_code != 206 or content_range(r) != (start, self.length):
+                raise IOError("Segment request rejected, status: %s" % r.status_code)
+            if self.etag and r.headers.get("ETag") != self.etag:
+                raise IOError("Download file changed on server.")
+            target.seek(start)
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                if self.cancelled() or self._failed.is_set():
+                    raise DownloadCancelled()
+                chunk = chunk[:segment["end"] - segment["start"] + 1 - segment["done"]]
+                target.write(chunk)
+                segment["done"] += len(chunk)
+                if self.throttle:
+                    self.throttle(len(chunk))
+                if self._finished(segment):
+                    break
+        if not self._finished(segment):
+            raise IOError("Segment incomplete.")
+
+    def verify(self, path, segments):
+        if not all(self._finished(segment) for segment in segments) or os.path.getsize(path) != self.length:
+            raise IOError("Segmented download size mismatch.")
+        if self.md5:
+            md5 = hashlib.md5()
+            with open(path, "rb") as archive:
+                for chunk in iter(lambda: archive.read(1024 * 1024), b""):
+                    md5.update(chunk)
+            if md5.hexdigest() != self.md5:
+                raise IOError("Segmented download checksum mismatch.")
+
+
+@contextmanager
+def _no_op():
+    yield
+
+
+def preallocate(path, length):
+    # 预先分配磁盘空间，空间不足时在下载前失败
+    with open(path, "r+b") as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, length)
+        except (AttributeError, OSError):
+            f.truncate(length)
+
+
+def probe_download(download_url):
+    """
+    只请求第一个字节，获取下载文件的大小和校验信息
+    :return: {"length", "etag", "last_modified", "md5", "ranges"}，请求失败时返回 None
+    """
+    with closing(cloud_client().get(download_url, stream=True, timeout=(10.0, 60.0),
+                                    endpoint=DOWNLOAD_ENDPOINT, headers={"Range": "bytes=0-0"})) as r:
+        if r.status_code not in (200, 206):
+            return None
+        etag = r.headers.get("ETag")
+        if etag and etag.startswith("W/"):
+            etag = None
+        if r.status_code == 206:
+            start, length = content_range(r)
+            ranges = start == 0 and not r.headers.get("Content-Encoding")
+        else:
+            length = r.headers.get("Content-Length")
+            length = int(length) if length and length.isdigit() and not r.headers.get("Content-Encoding") else None
+            ranges = False
+        return {"length": length, "etag": etag, "last_modified": r.headers.get("Last-Modified"),
+                "md5": response_md5(r), "ranges": ranges}
+
+
+def response_md5(response):
+    """
+    :return: 对象存储非分片上传时 ETag 即文件 MD5，其它 ETag 返回 None
+    """
+    etag = (response.headers.get("ETag") or "").strip('"').lower()
+    return etag if re.match(r"^[0-9a-f]{32}$", etag) else None
+
+
+def response_validator(response):
+    """
+    :return: {} 完整响应的校验信息，只有强 ETag 或 Last-Modified 且未压缩传输时才能续传
+    """
+    etag = response.headers.get("ETag")
+    if etag and etag.startswith("W/"):
+        etag = None
+    last_modified = response.headers.get("Last-Modified")
+    length = response.headers.get("Content-Length")
+    length = int(length) if length and length.isdigit() else None
+    resumable = bool(response.headers.get("Accept-Ranges", "").lower() == "bytes" and (etag or last_modified) and
+                     length is not None and not response.headers.get("Content-Encoding"))
+    return {"etag": etag, "last_modified": last_modified, "length": length, "resumable": resumable}
+
+
+def content_range(response):
+    """
+    :return: (start, total)  Content-Range: bytes 100-999/1000
+    """
+    match = re.match(r"bytes (\d+)-\d+/(\d+)", response.headers.get("Content-Range", ""))
+    if not match:
+        return None, None
+    return int(match.group(1)), int(match.group(2))
+
+
+def file_detail(content_data):
+    # list_files 返回的文件信息转换为云端文件列表的格式
+    return {
+        "file_type": "dir" if content_data["typePath"][0] == "folder" else "file",
+        "file_name": content_data["display"],
+        "real_name": content_data["name"],
+        "last_modified_time": timestamp_2_str(content_data["date"]) if "date" in content_data else "",
+        "file_size": content_data["size"] if "size" in content_data else ""
+    }
 
 
 def timestamp_2_str(timestamp):
@@ -551,12 +1064,3 @@ def timestamp_2_str(timestamp):
     except Exception as e:
         _logger.info("timestamp to strtime error.")
         return ""
-
-
-def get_dir_size(folder):
-    import os
-    from os.path import join, getsize
-    size_long = 0
-    for root, dirs, files in os.walk(folder):
-        size_long += sum([getsize(join(root, name)) for name in files])
-    return size_long / 1024 / 1024  # MB
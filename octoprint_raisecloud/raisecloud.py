@@ -3,8 +3,7 @@ from __future__ import absolute_import, unicode_literals
 import json
 import base64
 import logging
-import requests
-from Crypto.Cipher import AES
+from .http_client import cloud_client
 
 
 _logger = logging.getLogger('octoprint.plugins.raisecloud')
@@ -28,7 +27,7 @@ class RaiseCloud(object):
         }
         url = "{}{}".format(self.endpoint, self.url)
         try:
-            result = requests.post(url=url, json=body, verify=True)
+            result = cloud_client().post(url, json=body, verify=True)
             if result.status_code == 200:
                 data = json.loads(result.text)
                 state = data["state"]  # state 0-绑定到达上线， 1-正常返回token， 3-用户名密码不匹配
@@ -56,6 +55,7 @@ class Util(object):
     @staticmethod
     def decrypt(content):
         if content:
+            from Crypto.Cipher import AES  # 只在导入密钥文件时使用
             secret = 'raiseqwertyuiopa'
             key = secret.encode("utf8")  # 兼容 python3
             decode = base64.b64decode(content)
@@ -1,11 +1,17 @@
 # coding=utf-8
 from __future__ import absolute_import, unicode_literals
-import sqlite3
 import os
+import json
+import time
+import sqlite3
 import logging
+import threading
 
 _logger = logging.getLogger('octoprint.plugins.raisecloud')
 
+PROFILE_COLUMNS = ("id", "user_name", "group_name", "group_owner", "token", "machine_id", "content",
+                   "printer_name", "login_status", "task_id", "receive_job")
+
 
 def exception_wrapper(actual_do):
     def add_robust(*args, **kwargs):
@@ -18,21 +24,69 @@ def exception_wrapper(actual_do):
     return add_robust
 
 
+# singleton
+_instance = None
+
+
+def sqlite_server_instance(plugin):
+    global _instance
+    if _instance is None:
+        _instance = SqliteServer(plugin)
+    return _instance
+
+
 class SqliteServer(object):
 
     def __init__(self, plugin):
         self.path = os.path.join(plugin.get_plugin_data_folder(), "raisecloud.sqlite")
+        # 每个线程持有一个长连接，避免每条语句都重新打开数据库
+        self._local = threading.local()
+        self._conns = dict()  # thread -> conn
+        self._lock = threading.Lock()
+        # profile 行的内存缓存
+        self._profile = None
+        self._profile_lock = threading.RLock()
+        self.logout_event = threading.Event()
 
     def get_conn(self):
-        # 获取数据库连接
+        # 获取当前线程的数据库连接
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
         try:
-            conn = sqlite3.connect(self.path)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
             conn.text_factory = str
-            if os.path.exists(self.path) and os.path.isfile(self.path):
-                return conn
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
         except sqlite3.OperationalError as e:
             _logger.error("Connect to sqlite error ...")
             raise e
+        self._local.conn = conn
+        with self._lock:
+            # 下载、重连等短生命周期线程退出后关闭其连接，连接数不超过存活线程数
+            dead = [t for t in self._conns if not t.is_alive()]
+            stale = [self._conns.pop(t) for t in dead]
+            self._conns[threading.current_thread()] = conn
+        self._close(stale)
+        return conn
+
+    def release(self):
+        # 线程结束前主动关闭自己的连接
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+        with self._lock:
+            self._conns.pop(threading.current_thread(), None)
+        self._close([conn])
+
+    @staticmethod
+    def _close(conns):
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                _logger.error("Close sqlite conn error ...: %s" % e)
 
     def get_cursor(self, conn):
         #  获取数据库的游标对象，参数为数据库的连接对象
@@ -41,34 +95,57 @@ class SqliteServer(object):
         else:
             return self.get_conn().cursor()
 
-    def close_all(self, conn, cu):
-        # 关闭数据库游标对象和数据库连接对象
+    def close_all(self):
+        # 插件退出时关闭所有线程的数据库连接
+        with self._lock:
+            conns, self._conns = list(self._conns.values()), dict()
+        self._close(conns)
+        self._local = threading.local()
+
+    def _execute(self, sql, params=()):
+        conn = self.get_conn()
+        cu = self.get_cursor(conn)
         try:
+            cu.execute(sql, params)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            cu.close()
+
+    def _executemany(self, sql, data):
+        # 批量执行，整批只提交一次
+        conn = self.get_conn()
+        cu = self.get_cursor(conn)
+        try:
+            cu.executemany(sql, data)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        finally:
+            cu.close()
+
+    def _query(self, sql, params=()):
+        cu = self.get_cursor(self.get_conn())
+        try:
+            cu.execute(sql, params)
+            return cu.fetchall()
+        finally:
             cu.close()
-            conn.close()
-        except sqlite3.OperationalError as e:
-            _logger.error("Close sqlite cur error ...")
-            raise e
 
     def exec_sql(self, sql):
-        # 创建数据库表
+        # 执行sql语句
         if sql is not None and sql != '':
-            conn = self.get_conn()
-            cu = self.get_cursor(conn)
-            cu.execute(sql)
-            conn.commit()
-            self.close_all(conn, cu)
+            self._execute(sql)
         else:
             _logger.error('Exec sql [{}] error!'.format(sql))
 
     def create_table(self, sql):
         # 创建数据库表
         try:
-            conn = self.get_conn()
-            cu = self.get_cursor(conn)
-            cu.execute(sql)
-            conn.commit()
-            self.close_all(conn, cu)
+            self._execute(sql)
         except sqlite3.Error as e:
             _logger.error('Create table [{}] error!'.format(sql))
             raise e
@@ -76,14 +153,8 @@ class SqliteServer(object):
     def drop_table(self, table):
         # 如果表存在,则删除表
         try:
-            sql = 'DROP TABLE IF EXISTS ' + table
-            conn = self.get_conn()
-            cu = self.get_cursor(conn)
-            cu.execute(sql)
-            conn.commit()
+            self._execute('DROP TABLE IF EXISTS ' + table)
             _logger.info('Drop [{}] table success'.format(table))
-            cu.close()
-            conn.close()
         except sqlite3.Error:
             _logger.error('Drop table [{}] error'.format(table))
 
@@ -91,25 +162,16 @@ class SqliteServer(object):
         # 插入数据
         try:
             if data is not None:
-                conn = self.get_conn()
-                cu = self.get_cursor(conn)
-                for d in data:
-                    cu.execute(sql, d)
-                    conn.commit()
-                self.close_all(conn, cu)
+                self._executemany(sql, data)
         except sqlite3.Error:
             _logger.error('Insert [{}] wrong!'.format(sql))
 
     def fetchall(self, sql):
         # 查询所有数据
         try:
-            conn = self.get_conn()
-            cu = self.get_cursor(conn)
-            cu.execute(sql)
-            r = cu.fetchall()
+            r = self._query(sql)
             if len(r) > 0:
                 return r
-            self.close_all(conn, cu)
         except sqlite3.Error as e:
             _logger.error('Fetchall [{}] error!'.format(sql))
             _logger.error(e)
@@ -119,14 +181,9 @@ class SqliteServer(object):
         # 查询一条数据
         try:
             if data is not None:
-                d = (data,)
-                conn = self.get_conn()
-                cu = self.get_cursor(conn)
-                cu.execute(sql, d)
-                r = cu.fetchall()
+                r = self._query(sql, (data,))
                 if len(r) > 0:
                     return r[0]
-                self.close_all(conn, cu)
         except sqlite3.Error as e:
             _logger.error('Fetchone [{}] error!'.format(sql))
             _logger.error(e)
@@ -136,12 +193,7 @@ class SqliteServer(object):
         # 更新数据
         try:
             if data is not None:
-                conn = self.get_conn()
-                cu = self.get_cursor(conn)
-                for d in data:
-                    cu.execute(sql, d)
-                    conn.commit()
-                self.close_all(conn, cu)
+                self._executemany(sql, data)
         except sqlite3.Error as e:
             _logger.error('Update [{}] error!'.format(sql))
             _logger.error(e)
@@ -150,12 +202,7 @@ class SqliteServer(object):
         # 删除数据
         try:
             if data is not None:
-                conn = self.get_conn()
-                cu = self.get_cursor(conn)
-                for d in data:
-                    cu.execute(sql, d)
-                    conn.commit()
-                self.close_all(conn, cu)
+                self._executemany(sql, data)
         except sqlite3.Error as e:
             _logger.error('Delete [{}] error!'.format(sql))
             _logger.error(e)
@@ -180,54 +227,211 @@ class SqliteServer(object):
         except sqlite3.Warning as e:
             _logger.error('Delete [{}] error!'.format(create_tb_sql))
             raise e
+        create_outbox_sql = '''CREATE TABLE IF NOT EXISTS `outbox` (
+                                 `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+                                 `message_type` int,
+                                 `task_id` varchar(30),
+                                 `state` int,
+                                 `payload` text,
+                                 `created` real
+                               )'''
+        self.create_table(create_outbox_sql)
+        create_job_queue_sql = '''CREATE TABLE IF NOT EXISTS `job_queue` (
+                                    `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+                                    `task_id` varchar(30),
+                                    `download_url` text,
+                                    `filename` text,
+                                    `state` varchar(30),
+                                    `file_path` text,
+                                    `created` real
+                                  )'''
+        self.create_table(create_job_queue_sql)
+        create_file_cache_sql = '''CREATE TABLE IF NOT EXISTS `file_cache` (
+                                     `cache_key` text PRIMARY KEY,
+                                     `file_path` text,
+                                     `size` int,
+                                     `mtime` real,
+                                     `created` real,
+                                     `last_used` real
+                                   )'''
+        self.create_table(create_file_cache_sql)
+        self._add_column("file_cache", "mtime", "real")
+        if self.check_login_status() == "logout":
+            self.logout_event.set()
+
+    def _add_column(self, table, column, column_type):
+        # 旧版本创建的表缺少新增的列
+        columns = [row[1] for row in self._query('PRAGMA table_info({})'.format(table))]
+        if column not in columns:
+            self._execute('ALTER TABLE {} ADD COLUMN `{}` {}'.format(table, column, column_type))
+
+    def _load_profile(self):
+        # profile 只有 id = 1 一行，首次访问时读入内存，之后的读取不再访问磁盘
+        with self._profile_lock:
+            if self._profile is None:
+                fetchone_sql = 'SELECT {} FROM profile WHERE ID = ? '.format(', '.join(PROFILE_COLUMNS))
+                try:
+                    r = self._query(fetchone_sql, (1,))
+                except sqlite3.Error as e:
+                    _logger.error('Load profile error!')
+                    _logger.error(e)
+                    return {}
+                self._profile = dict(zip(PROFILE_COLUMNS, r[0])) if r else {}
+            return self._profile
+
+    def _get_profile_field(self, key):
+        return self._load_profile().get(key)
+
+    def _set_profile_fields(self, **fields):
+        # write through: 先写数据库，写入成功后再更新缓存
+        update_sql = 'UPDATE profile SET {} WHERE id = ? '.format(', '.join('{} = ?'.format(k) for k in fields))
+        update_data = [tuple(fields.values()) + (1,)]
+        with self._profile_lock:
+            try:
+                self._executemany(update_sql, update_data)
+            except sqlite3.Error as e:
+                _logger.error('Update [{}] error!'.format(update_sql))
+                _logger.error(e)
+                return False
+            profile = self._load_profile()
+            if profile:
+                profile.update(fields)
+            return True
 
     def check_user_status(self, user_name):
-        result = self.fetchone('SELECT user_name FROM profile WHERE id = ? ', 1)
-        return True if result and result[0] == user_name else False
+        return self._get_profile_field("user_name") == user_name
 
     def update_user_data(self, user_name, group_name, group_owner, token, machine_id, content):
-        fetchone_sql = 'SELECT user_name, group_name, group_owner, token, machine_id, content FROM profile WHERE ID = ? '
-        query_res = self.fetchone(fetchone_sql, 1)
-        if query_res:
-            update_sql = 'UPDATE profile SET user_name = ?, group_name = ?, group_owner = ?, token = ?, machine_id = ?, content = ? WHERE id = ?'
-            update_data = [(user_name, group_name, group_owner, token, machine_id, content, 1)]
-            self.update(update_sql, update_data)
-        else:
-            insert_sql = '''INSERT INTO profile values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
-            insert_data = [(1, user_name, group_name, group_owner, token, machine_id, content, None, None, None, None)]
-            self.insert(insert_sql, insert_data)
+        with self._profile_lock:
+            if self._load_profile():
+                self._set_profile_fields(user_name=user_name, group_name=group_name, group_owner=group_owner,
+                                         token=token, machine_id=machine_id, content=content)
+            else:
+                insert_sql = '''INSERT INTO profile values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+                insert_data = [(1, user_name, group_name, group_owner, token, machine_id, content, None, None, None, None)]
+                self.insert(insert_sql, insert_data)
+                self._profile = None  # 下次访问时重新加载
 
     def check_login_status(self):
-        fetchone_sql = 'SELECT login_status FROM profile WHERE ID = ? '
-        status = self.fetchone(fetchone_sql, 1)
-        return status[0] if status else status
+        return self._get_profile_field("login_status")
 
     def set_login_status(self, status):
-        update_sql = 'UPDATE profile SET login_status = ? WHERE id = ? '
-        update_data = [(status, 1)]
-        self.update(update_sql, update_data)
+        self._set_profile_fields(login_status=status)
+        if status == "logout":
+            self.logout_event.set()
+        else:
+            self.logout_event.clear()
+
+    def get_token(self):
+        return self._get_profile_field("token")
+
+    def set_token(self, token):
+        self._set_profile_fields(token=token)
+
+    def get_receive_job(self):
+        return self._get_profile_field("receive_job")
+
+    def set_receive_job(self, status):
+        self._set_profile_fields(receive_job=status)
 
     def get_content(self):
-        fetchone_sql = 'SELECT content FROM profile WHERE ID = ? '
-        content = self.fetchone(fetchone_sql, 1)
-        return content[0] if content else content
+        return self._get_profile_field("content")
 
     def set_content(self, content):
-        update_sql = 'UPDATE profile SET content = ? WHERE id = ? '
-        update_data = [(content, 1)]
-        self.update(update_sql, update_data)
+        self._set_profile_fields(content=content)
 
     def delete_content(self):
-        update_sql = 'UPDATE profile SET content = ? WHERE id = ? '
-        update_data = [(None, 1)]
-        self.update(update_sql, update_data)
+        self._set_profile_fields(content=None)
 
     def get_user_name(self):
-        fetchone_sql = 'SELECT user_name FROM profile WHERE ID = ? '
-        user_name = self.fetchone(fetchone_sql, 1)
-        return user_name[0] if user_name else user_name
+        return self._get_profile_field("user_name")
 
     def get_current_info(self):
-        fetchone_sql = 'SELECT user_name, group_name, group_owner FROM profile WHERE ID = ? '
-        res = self.fetchone(fetchone_sql, 1)
-        return res if res else None
+        profile = self._load_profile()
+        if not profile:
+            return None
+        return profile["user_name"], profile["group_name"], profile["group_owner"]
+
+
+class Outbox(object):
+    """
+    离线发件箱，连接断开或发送队列已满时保存任务状态消息，之后按顺序补发
+    """
+
+    def __init__(self, sqlite_server, max_entries=100, max_age=24 * 3600):
+        self.sqlite_server = sqlite_server
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.pending = True  # 启动时数据库中可能还有未发送的消息
+        self._lock = threading.Lock()
+
+    def append(self, message):
+        data = message.get("data") or {}
+        message_type = message.get("message_type")
+        task_id = data.get("task_id")
+        state = message.get("state")
+        with self._lock:
+            # 相同任务的相同状态只保留最新的一条
+            delete_sql = 'DELETE FROM outbox WHERE message_type = ? AND task_id IS ? AND state IS ? '
+            self.sqlite_server.delete(delete_sql, [(message_type, task_id, state)])
+            insert_sql = 'INSERT INTO outbox (message_type, task_id, state, payload, created) values (?, ?, ?, ?, ?)'
+            self.sqlite_server.insert(insert_sql, [(message_type, task_id, state, json.dumps(message), time.time())])
+            self._expire()
+            self.pending = True
+        _logger.info("Raisecloud message type %s is undelivered, saved to outbox." % message_type)
+
+    def _expire(self):
+        expire_sql = 'DELETE FROM outbox WHERE created < ? OR id NOT IN (SELECT id FROM outbox ORDER BY id DESC LIMIT ?)'
+        self.sqlite_server.delete(expire_sql, [(time.time() - self.max_age, self.max_entries)])
+
+    def pop_all(self):
+        """
+        :return: 按保存顺序返回所有未过期的消息，并从发件箱中删除
+        """
+        with self._lock:
+            self._expire()
+            rows = self.sqlite_server.fetchall('SELECT id, payload FROM outbox ORDER BY id') or []
+            if rows:
+                self.sqlite_server.delete('DELETE FROM outbox WHERE id <= ? ', [(rows[-1][0],)])
+            self.pending = False
+        return [json.loads(payload) for _, payload in rows]
+
+
+class FileCache(object):
+    """
+    任务文件缓存：按压缩包的校验值（服务器提供的 MD5 或 ETag）记录已导入的 gcode，
+    重复下发的任务直接使用本地文件，不再下载和解压
+    """
+
+    def __init__(self, sqlite_server):
+        self.sqlite_server = sqlite_server
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cache_key):
+        """
+        :return: (file_path, size, mtime)，没有缓存时返回 None
+        """
+        row = self.sqlite_server.fetchone('SELECT file_path, size, mtime FROM file_cache WHERE cache_key = ? ', cache_key)
+        if row:
+            self.hits += 1
+            self.sqlite_server.update('UPDATE file_cache SET last_used = ? WHERE cache_key = ? ', [(time.time(), cache_key)])
+        else:
+            self.misses += 1
+        return row
+
+    def put(self, cache_key, file_path, size, mtime):
+        with self._lock:
+            # 同名任务会覆盖文件，旧的缓存记录随之失效
+            self.sqlite_server.delete('DELETE FROM file_cache WHERE cache_key = ? OR file_path = ? ', [(cache_key, file_path)])
+            insert_sql = 'INSERT INTO file_cache (cache_key, file_path, size, mtime, created, last_used) values (?, ?, ?, ?, ?, ?)'
+            now = time.time()
+            self.sqlite_server.insert(insert_sql, [(cache_key, file_path, size, mtime, now, now)])
+
+    def remove(self, cache_key):
+        self.sqlite_server.delete('DELETE FROM file_cache WHERE cache_key = ? ', [(cache_key,)])
+
+    def remove_path(self, path):
+        # 文件或所在文件夹被删除
+        self.sqlite_server.delete('DELETE FROM file_cache WHERE file_path = ? OR file_path LIKE ? ', [(path, path.rstrip("/") + "/%")])
@@ -11,6 +11,7 @@ $(function() {
     self.fileName = ko.observable("");
     self.printer_name = ko.observable("");
     self.disabled = ko.observable(true);
+    self.bedClearNotice = undefined;
 
     self.turnRaise = function() {
       window.open("http://cloud.raise3d.com/raise3d.html");
@@ -113,11 +114,80 @@ $(function() {
             self.groupName(data.group_name);
             self.groupOwner(data.group_owner);
             self.printer_name(data.printer_name);
+            if (data.waiting_bed_clear) {
+              self.showBedClear();
+            }
           }
         },
         error: function(error) {}
       });
     })();
+    // 打印结束后确认打印平台已清空，开始队列中的下一个云端任务
+    self.showBedClear = function() {
+      if (self.bedClearNotice !== undefined) {
+        return;
+      }
+      self.bedClearNotice = new PNotify({
+        title: gettext("RaiseCloud queued task"),
+        text: gettext("The print has finished. Remove the print from the bed, then start the next queued RaiseCloud task."),
+        type: "info",
+        hide: false,
+        buttons: {
+          closer: false,
+          sticker: false
+        },
+        confirm: {
+          confirm: true,
+          buttons: [
+            {
+              text: gettext("Bed is clear, start next task"),
+              addClass: "btn-primary",
+              click: function(notice) {
+                self.confirmBedClear();
+              }
+            },
+            {
+              text: gettext("Later"),
+              click: function(notice) {
+                self.hideBedClear();
+              }
+            }
+          ]
+        }
+      });
+    };
+    self.hideBedClear = function() {
+      if (self.bedClearNotice !== undefined) {
+        self.bedClearNotice.remove();
+        self.bedClearNotice = undefined;
+      }
+    };
+    self.confirmBedClear = function() {
+      self.hideBedClear();
+      $.ajax({
+        type: "POST",
+        contentType: "application/json; charset=utf-8",
+        url: PLUGIN_BASEURL + "raisecloud/queue/bed_clear",
+        data: {},
+        dataType: "json",
+        success: function(data) {
+          if (data.status == "failed") {
+            new PNotify({
+              title: gettext("RaiseCloud queued task"),
+              text: gettext("There is no queued task to start."),
+              type: "warning"
+              });
+          }
+        },
+        error: function(error) {
+          new PNotify({
+            title: gettext("RaiseCloud queued task"),
+            text: gettext("Fail to start the next queued task, please try again."),
+            type: "error"
+            });
+        }
+      });
+    };
     //edit文本框的blur事件
     self.onPrintName = function() {
       if (!$(".input").val()) {
@@ -232,6 +302,12 @@ $(function() {
                     type: "success"
                     });
                     break;
+                case "BedClear":
+                    self.showBedClear();
+                    break;
+                case "BedClearConfirmed":
+                    self.hideBedClear();
+                    break;
                 case "ChangeProfile":
                     new PNotify({
                     title: gettext("Change octoprint profile successful"),
@@ -1,7 +1,10 @@
 # coding=utf-8
 from __future__ import absolute_import, unicode_literals
+import re
+import time
 import requests
 import logging
+import threading
 import traceback
 import warnings
 # Python2/3 compatible import
@@ -10,18 +13,50 @@ try:
 except ImportError:
     from io import BytesIO as StringIO
 from contextlib import closing
-from requests_toolbelt import MultipartEncoder
-from multiprocessing.pool import ThreadPool
-pool = ThreadPool(5)
+from .http_client import cloud_client, webcam_client
 _logger = logging.getLogger('octoprint.plugins.raisecloud')
 
-try:
-    from PIL import Image
-except ImportError:
-    Image = None
-    import subprocess
-    traceback.print_exc()
-    warnings.warn("Pillow is not available. make sure it is installed.")
+SNAPSHOT_FRESHNESS = 0.5  # 秒，上一张截图在这段时间内上传成功时不再重复上传
+FRAME_MAX_AGE = 1.0  # 秒，视频流缓存帧超过这个时间不再使用
+
+# 截图上传的分辨率上限和 JPEG 质量，original 保持原图
+SNAPSHOT_PROFILES = {
+    "original": (None, 85),
+    "hd": ((1280, 720), 80),
+    "sd": ((640, 480), 70),
+    "low": ((320, 240), 60)
+}
+
+# Pillow 和上传线程池在第一次截图时才创建，不影响 OctoPrint 启动
+_image_module = None
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pil_image():
+    """
+    :return: PIL.Image，没有安装 Pillow 时返回 None，改用 ImageMagick
+    """
+    global _image_module
+    if _image_module is None:
+        try:
+            from PIL import Image
+            _image_module = Image
+        except ImportError:
+            _image_module = False
+            traceback.print_exc()
+            warnings.warn("Pillow is not available. make sure it is installed.")
+    return _image_module or None
+
+
+def upload_pool():
+    # 截图上传同一时间只有一个，一个线程即可
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from multiprocessing.pool import ThreadPool
+            _pool = ThreadPool(1)
+        return _pool
 
 
 _instance_camera = None
@@ -41,79 +76,162 @@ class Webcam(object):
         self.plugin = plugin
         self.settings = plugin._settings
         self.cam_status = True
-        # self.snapshot_url = self.settings.global_get(["webcam", "snapshot"])
-        # self.camera_url = self.settings.global_get(["webcam", "stream"])
-        # self.image_transpose = (self.settings.global_get(["webcam", "flipH"]) or
-        #                          self.settings.global_get(["webcam", "flipV"]) or
-        #                          self.settings.global_get(["webcam", "rotate90"]))
+        # 同一时间只有一个截图上传
+        self._lock = threading.Lock()
+        self._in_flight = False
+        self._last_upload = 0
+        self.uploads = 0
+        self.joined = 0  # 上传进行中到达的请求
+        self.cached = 0  # 由刚上传的截图满足的请求
+        self.grabber = StreamGrabber(plugin)
 
-    def check_cam_status(self):
+    def fetch_snapshot(self):
+        """
+        请求一次摄像头截图，同时更新摄像头状态
+        :return: 图片数据，失败时返回 None
+        """
         snapshot_url = self.settings.global_get(["webcam", "snapshot"])
-        camera_url = self.settings.global_get(["webcam", "stream"])
-        if snapshot_url and camera_url:
-            try:
-                result = requests.get(snapshot_url)
-                if result.status_code == 200:
-                    self.cam_status = True
-                else:
-                    self.cam_status = False
-            except Exception as e:
-                self.cam_status = False
-                _logger.error("Error getting camera status: %s" % e)
+        if not snapshot_url:
+            self.cam_status = False
+            return None
+        try:
+            with closing(webcam_client().get(snapshot_url)) as res:
+                self.cam_status = res.status_code == 200
+                return res.content if self.cam_status else None
+        except Exception as e:
+            self.cam_status = False
+            _logger.error("Error getting camera status: %s" % e)
+            return None
+
+    def transforms(self):
+        # OctoPrint 摄像头设置中的翻转和旋转
+        return [key for key in ("flipH", "flipV", "rotate90") if self.settings.global_get_boolean(["webcam", key])]
+
+    def stream_url(self):
+        """
+        :return: 本机可访问的 MJPEG 视频流地址，stream 为相对地址时由 mjpg-streamer 的截图地址推出
+        """
+        stream_url = self.settings.global_get(["webcam", "stream"])
+        if stream_url and stream_url.startswith(("http://", "https://")):
+            return stream_url
+        snapshot_url = self.settings.global_get(["webcam", "snapshot"])
+        if snapshot_url and "action=snapshot" in snapshot_url:
+            return snapshot_url.replace("action=snapshot", "action=stream")
+        return None
+
+    def grab_frame(self):
+        # 开启视频流模式时从常驻连接的最新帧获取截图，取不到时再单独请求
+        if not self.settings.get_boolean(["webcam_stream_grabber"]):
+            return None
+        stream_url = self.stream_url()
+        if not stream_url:
+            return None
+        frame = self.grabber.latest(stream_url)
+        if frame:
+            self.cam_status = True
+        return frame
+
+    def profile(self):
+        return SNAPSHOT_PROFILES.get(self.settings.get(["snapshot_profile"]), SNAPSHOT_PROFILES["original"])
 
     def get_snapshot(self):
-            self.check_cam_status()
-            if not self.cam_status:
-                return None
-            else:
-                try:
-                    snapshot_url = self.settings.global_get(["webcam", "snapshot"])
-                    with closing(requests.get(snapshot_url)) as res:
-                        pic = res.content
-                    # result = requests.get(self.snapshot_url)
-                    # pic = result.content
-                    if pic is not None:
-                        if Image:
-                            buf = StringIO()
-                            buf.write(pic)
-                            image = Image.open(buf)
-                            # if self.settings.global_get(["webcam", "flipH"]):
-                            #     image = image.transpose(Image.FLIP_LEFT_RIGHT)
-                            # if self.settings.global_get(["webcam", "flipV"]):
-                            #     image = image.transpose(Image.FLIP_TOP_BOTTOM)
-                            # if self.settings.global_get(["webcam", "rotate90"]):
-                            #     image = image.transpose(Image.ROTATE_90)
-                            transformed_image = StringIO()
-                            image.save(transformed_image, format="jpeg")
-                            transformed_image.seek(0, 2)
-                            transformed_image.seek(0)
-                            pic = transformed_image.read()
-                        else:
-                            args = ["convert", "-"]
-                            # if self.settings.global_get(["webcam", "flipV"]):
-                            #     args += ["-flip"]
-                            # if self.settings.global_get(["webcam", "flipH"]):
-                            #     args += ["-flop"]
-                            # if self.settings.global_get(["webcam", "rotate90"]):
-                            #     args += ["-rotate", "90"]
-                            args += "jpeg:-"
-                            p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-                            pic, _ = p.communicate(pic)
-                    return pic
-                except Exception as e:
-                    _logger.error("Get snapshot from webcam error.")
-                    _logger.error(e)
-                    return None
+        pic = self.grab_frame() or self.fetch_snapshot()
+        if not pic:
+            return None
+        transforms = self.transforms()
+        size, quality = self.profile()
+        if not transforms and not size and is_jpeg(pic):
+            # 已经是 JPEG 且不需要变换时直接上传，不重新编码
+            return pic
+        try:
+            return self.encode(pic, transforms, quality, size)
+        except Exception as e:
+            _logger.error("Get snapshot from webcam error.")
+            _logger.error(e)
+            return None
+
+    def live_frame(self, quality):
+        """
+        实时画面的一帧，按指定质量重新编码；没有 Pillow 时只能直接发送原图
+        """
+        pic = self.grab_frame() or self.fetch_snapshot()
+        if not pic:
+            return None
+        if not pil_image() and is_jpeg(pic) and not self.transforms():
+            return pic
+        return self.encode(pic, self.transforms(), quality, self.profile()[0])
+
+    def encode(self, pic, transforms, quality=None, size=None):
+        """
+        按 OctoPrint 的摄像头设置翻转、旋转，缩小到 size 以内后编码为 JPEG
+        size: (宽, 高)，为 None 时保持原分辨率
+        """
+        if size and "rotate90" in transforms:
+            size = (size[1], size[0])  # 旋转前的尺寸
+        Image = pil_image()
+        if Image:
+            image = Image.open(StringIO(pic))
+            if size:
+                # JPEG 解码时直接按 1/2、1/4、1/8 缩小（DCT scaling），再缩放剩余部分
+                image.draft("RGB", size)
+                image.thumbnail(size, Image.BILINEAR)
+            if "flipH" in transforms:
+                image = image.transpose(Image.FLIP_LEFT_RIGHT)
+            if "flipV" in transforms:
+                image = image.transpose(Image.FLIP_TOP_BOTTOM)
+            if "rotate90" in transforms:
+                image = image.transpose(Image.ROTATE_90)
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            transformed_image = StringIO()
+            image.save(transformed_image, format="jpeg", quality=quality or 75, optimize=True, progressive=True)
+            return transformed_image.getvalue()
+        args = ["convert"]
+        if size:
+            # jpeg:size 让 ImageMagick 在解码时缩小
+            args += ["-define", "jpeg:size={}x{}".format(size[0] * 2, size[1] * 2), "-", "-thumbnail",
+                     "{}x{}>".format(size[0], size[1])]
+        else:
+            args += ["-"]
+        if "flipH" in transforms:
+            args += ["-flop"]
+        if "flipV" in transforms:
+            args += ["-flip"]
+        if "rotate90" in transforms:
+            args += ["-rotate", "-90"]  # 与 OctoPrint 一致，逆时针旋转
+        if quality:
+            args += ["-quality", str(quality)]
+        args += ["-interlace", "JPEG", "jpeg:-"]
+        import subprocess
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        pic, _ = p.communicate(pic)
+        return pic
+
+    def _upload_snapshot_once(self, machine_id, token):
+        started = time.time()
+        success = False
+        try:
+            success = self._upload_snapshot(machine_id, token)
+        except Exception as e:
+            _logger.error("Upload snapshot error: %s" % e)
+        finally:
+            with self._lock:
+                self._in_flight = False
+                if success:
+                    self.uploads += 1
+                    self._last_upload = started
 
     def _upload_snapshot(self, machine_id, token):
         pic = self.get_snapshot()
         if not pic:
             return False
+        from requests_toolbelt import MultipartEncoder
         url = "https://api.raise3d.com/octoprod-v1.1/machine/uploadImage"
         data = MultipartEncoder({'file': ('snapshot.jpg', pic), 'machine_id': machine_id})
         headers = {"Content-Type": data.content_type, "Authorization": token}
         try:
-            result = requests.post(url=url, data=data, headers=headers)
+            # 截图较小，转成 bytes 发送，连接池重试时可以重发请求体
+            result = cloud_client().post(url, data=data.to_string(), headers=headers)
             data = None  # Free the memory
             status = result.status_code
         except requests.exceptions.HTTPError:
@@ -123,13 +241,159 @@ class Webcam(object):
         if status != 200:
             if self.sleep_times % 10 == 0:
                 _logger.info("RaiseCloud plugin get snapshot error.")
+        return status == 200
 
     def upload_snapshot(self, machine_id, token):
         if self.cam_status or self.sleep_times % 10 == 0:
-            # upload_thread = threading.Thread(target=self._upload_snapshot, args=(machine_id, token))
-            # upload_thread.daemon = True
-            # upload_thread.start()
-
-            # async_result = pool.apply_async(self._upload_snapshot, (machine_id, token))
-            pool.apply_async(self._upload_snapshot, (machine_id, token))
+            with self._lock:
+                if self._in_flight:
+                    # 合并到正在进行的截图上传
+                    self.joined += 1
+                elif time.time() - self._last_upload < SNAPSHOT_FRESHNESS:
+                    # 刚上传的截图足够新，不再重复截图上传
+                    self.cached += 1
+                else:
+                    self._in_flight = True
+                    upload_pool().apply_async(self._upload_snapshot_once, (machine_id, token))
         self.sleep_times += 1
+
+    def stats(self):
+        return {
+            "uploads": self.uploads,
+            "joined": self.joined,
+            "cached": self.cached,
+            "avoided": self.joined + self.cached
+        }
+
+
+def is_jpeg(data):
+    # JPEG 以 SOI 标记 FF D8 FF 开头
+    return data[:3] == b"\xff\xd8\xff"
+
+
+def shutdown_webcam():
+    global _pool
+    if _instance_camera:
+        _instance_camera.grabber.stop()
+    with _pool_lock:
+        if _pool is not None:
+            _pool.terminate()
+            _pool = None
+
+
+class StreamGrabber(object):
+    """
+    与 MJPEG 视频流保持一个长连接，只保留最新的一帧，截图直接从内存读取；
+    一段时间没有截图请求后自动断开
+    """
+
+    def __init__(self, plugin):
+        self.settings = plugin._settings
+        self.frame = None
+        self.frame_time = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._last_request = 0
+        self._failed_at = 0
+        self.frames = 0
+
+    def latest(self, url, max_age=FRAME_MAX_AGE, wait=2.0):
+        """
+        :return: 不超过 max_age 的最新帧，连接失败或超时时返回 None
+        """
+        self._last_request = time.time()
+        self._ensure_running(url)
+        deadline = time.time() + wait
+        with self._cond:
+            while time.time() - self.frame_time > max_age and self._thread is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if time.time() - self.frame_time <= max_age:
+                return self.frame
+        return None
+
+    def _ensure_running(self, url):
+        with self._cond:
+            # 连接失败后 10s 内不再重试，直接使用截图地址
+            if self._stopped or self._thread is not None or time.time() - self._failed_at < 10:
+                return
+            self._thread = threading.Thread(target=self._run, args=(url,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+
+    def _idle(self):
+        return time.time() - self._last_request > self.settings.get_int(["webcam_grabber_idle_timeout"])
+
+    def _run(self, url):
+        _logger.info("Connect to webcam stream: %s" % url)
+        try:
+            with closing(webcam_client().get(url, stream=True, timeout=(3.0, 10.0))) as res:
+                match = re.search(r"boundary=\"?([^\";]+)", res.headers.get("Content-Type", ""))
+                if res.status_code != 200 or not match:
+                    raise IOError("Not a MJPEG stream, status: %s" % res.status_code)
+                parser = MjpegParser(match.group(1))
+                for chunk in res.iter_content(chunk_size=8192):
+                    frames = parser.feed(chunk)
+                    if frames:
+                        with self._cond:
+                            self.frame = frames[-1]
+                            self.frame_time = time.time()
+                            self.frames += len(frames)
+                            self._cond.notify_all()
+                    if self._stopped or self._idle():
+                        break
+            _logger.info("Webcam stream disconnected.")
+        except Exception as e:
+            self._failed_at = time.time()
+            _logger.info("Webcam stream error: %s" % e)
+        finally:
+            with self._cond:
+                self._thread = None
+                self._cond.notify_all()
+
+
+class MjpegParser(object):
+    """
+    增量解析 multipart/x-mixed-replace 数据，有 Content-Length 时按长度读取，否则查找下一个分隔符
+    """
+    MAX_HEADER = 64 * 1024
+
+    def __init__(self, boundary):
+        self.boundary = b"--" + boundary.lstrip("-").encode("ascii")
+        self._buffer = bytearray()
+        self._length = None  # 当前帧的长度，None 表示正在读取帧头，-1 表示没有长度
+
+    def feed(self, data):
+        """
+        :return: 本次解析出的完整帧
+        """
+        self._buffer.extend(data)
+        frames = []
+        while True:
+            if self._length is None:
+                header_end = self._buffer.find(b"\r\n\r\n")
+                if header_end < 0:
+                    if len(self._buffer) > self.MAX_HEADER:
+                        del self._buffer[:-4]  # 不是有效的帧头，丢弃
+                    break
+                match = re.search(br"content-length:\s*(\d+)", bytes(self._buffer[:header_end]), re.IGNORECASE)
+                self._length = int(match.group(1)) if match else -1
+                del self._buffer[:header_end + 4]
+            if self._length >= 0:
+                if len(self._buffer) < self._length:
+                    break
+                frame_end = self._length
+            else:
+                frame_end = self._buffer.find(self.boundary)
+                if frame_end < 0:
+                    break
+            frames.append(bytes(self._buffer[:frame_end]).rstrip(b"\r\n"))
+            del self._buffer[:frame_end]
+            self._length = None
+        return frames
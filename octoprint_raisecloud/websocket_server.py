@@ -1,14 +1,169 @@
 # coding=utf-8
 import ssl
+import json
+import time
+import heapq
 import logging
-import websocket
+import itertools
+import threading
 _logger = logging.getLogger('octoprint.plugins.raisecloud')
-websocket.enableTrace(False)
+
+# 发送优先级，数值越小越先发送
+PRIORITY_HIGH = 0     # 心跳、任务状态消息
+PRIORITY_NORMAL = 1   # 远程指令的回复
+PRIORITY_LOW = 2      # 打印机状态上报、实时画面
+JOB_STATE_TYPES = (2, 3, 9, 12)
+TELEMETRY_TYPE = 1
+FRAME_TYPE = 15
+
+
+def message_type(data):
+    try:
+        return int(data["message_type"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def is_critical(data):
+    # 任务状态消息，连接断开时需要保存到离线发件箱
+    return message_type(data) in JOB_STATE_TYPES
+
+
+def message_priority(data, ping=False):
+    if ping:
+        return PRIORITY_HIGH
+    mtype = message_type(data)
+    if mtype in JOB_STATE_TYPES:
+        return PRIORITY_HIGH
+    if mtype in (TELEMETRY_TYPE, FRAME_TYPE):
+        return PRIORITY_LOW
+    return PRIORITY_NORMAL
+
+
+class SendQueue(object):
+    """
+    有界优先级发送队列，队列中尚未发送的状态上报会合并为一帧，尚未发送的实时画面只保留最新的一帧
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._telemetry = None
+        self._frame = None
+        self._closed = False
+        self.enqueued = 0
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.frames_replaced = 0
+        self.bytes_sent = 0
+        self.latency = 0.0  # 入队到发送的平均耗时（秒）
+
+    def put(self, data, ping=False):
+        priority = message_priority(data, ping)
+        is_frame = not ping and message_type(data) == FRAME_TYPE
+        with self._cond:
+            if self._closed:
+                return False
+            if is_frame and self._frame is not None:
+                # 上一帧还没发出，直接替换
+                self._frame[3] = data
+                self.frames_replaced += 1
+                return True
+            if priority == PRIORITY_LOW and not is_frame and self._telemetry is not None:
+                # 合并仍在队列中的状态上报
+                queued = self._telemetry[3]
+                queued["data"].update(data["data"])
+                queued.update(dict((k, v) for k, v in data.items() if k != "data"))
+                self.merged += 1
+                return True
+
+            if len(self._heap) >= self.maxsize:
+                worst = max(self._heap)
+                # 已入队的高优先级消息不淘汰，被拒绝的任务状态消息由调用方存入离线发件箱
+                if worst[0] < priority or worst[0] == PRIORITY_HIGH:
+                    self.dropped += 1
+                    return False
+                self._heap.remove(worst)
+                heapq.heapify(self._heap)
+                if worst is self._telemetry:
+                    self._telemetry = None
+                if worst is self._frame:
+                    self._frame = None
+                self.dropped += 1
+
+            if priority == PRIORITY_LOW and not is_frame:
+                data = dict(data, data=dict(data["data"]))
+            entry = [priority, next(self._seq), time.time(), data, ping]
+            heapq.heappush(self._heap, entry)
+            if is_frame:
+                self._frame = entry
+            elif priority == PRIORITY_LOW:
+                self._telemetry = entry
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self._heap))
+            self._cond.notify()
+            return True
+
+    def get(self):
+        """
+        :return: (data, ping, enqueue_time)，队列关闭时返回 None
+        """
+        with self._cond:
+            while not self._heap and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            entry = heapq.heappop(self._heap)
+            if entry is self._telemetry:
+                self._telemetry = None
+            if entry is self._frame:
+                self._frame = None
+            return entry[3], entry[4], entry[2]
+
+    def done(self, enqueue_time, size=0):
+        with self._cond:
+            self.sent += 1
+            self.bytes_sent += size
+            self.latency = self.latency * 0.8 + (time.time() - enqueue_time) * 0.2
+
+    def close(self):
+        """
+        :return: 队列中尚未发送的消息
+        """
+        with self._cond:
+            pending = [entry[3] for entry in sorted(self._heap, key=lambda x: x[1]) if not entry[4]]
+            self._closed = True
+            self._heap = []
+            self._telemetry = None
+            self._frame = None
+            self._cond.notify_all()
+            return pending
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "depth": len(self._heap),
+                "max_depth": self.max_depth,
+                "enqueued": self.enqueued,
+                "sent": self.sent,
+                "merged": self.merged,
+                "dropped": self.dropped,
+                "frames_replaced": self.frames_replaced,
+                "bytes_sent": self.bytes_sent,
+                "latency_ms": int(self.latency * 1000)
+            }
 
 
 class WebsocketServer(object):
 
-    def __init__(self, url, on_server_ws_msg):
+    def __init__(self, url, on_server_ws_msg, on_undelivered=None):
+        # 登录后才需要连接云端，第一次连接时再导入
+        import websocket
+        websocket.enableTrace(False)
 
         def on_message(ws, message):
             on_server_ws_msg(ws, message)
@@ -25,22 +180,52 @@ class WebsocketServer(object):
                                          on_message=on_message,
                                          on_close=on_close,
                                          on_error=on_error)
+        self.queue = SendQueue()
+        self.on_undelivered = on_undelivered
 
     def run(self):
+        writer = threading.Thread(target=self._writer)
+        writer.daemon = True
+        writer.start()
         self.ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
 
+    def _writer(self):
+        # 唯一的发送线程，调用方只负责入队，不会阻塞在网络上
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            data, ping, enqueue_time = item
+            if not self.connected():
+                self._undelivered(data, ping)
+                continue
+            try:
+                payload = data if ping else json.dumps(data)
+                self.ws.send(payload)
+                self.queue.done(enqueue_time, len(payload))
+            except Exception as e:
+                _logger.error("Raisecloud send message error: %s" % e)
+                self._undelivered(data, ping)
+
+    def _undelivered(self, data, ping=False):
+        if self.on_undelivered and not ping and is_critical(data):
+            self.on_undelivered(data)
+
     def send_text(self, data, ping=False):
-        import json
-        if self.connected():
-            if ping:
-                self.ws.send(data)
-            else:
-                self.ws.send(json.dumps(data))
+        if self.connected() and self.queue.put(data, ping):
+            return True
+        self._undelivered(data, ping)
+        return False
+
+    def metrics(self):
+        return self.queue.metrics()
 
     def connected(self):
         return self.ws.sock and self.ws.sock.connected
 
     def disconnect(self):
+        for data in self.queue.close():
+            self._undelivered(data)
         self.ws.keep_running = False
         self.ws.close()
 
@@ -0,0 +1,130 @@
+# coding=utf-8
+"""
+任务文件从开始下载到 gcode 可以打印的耗时：边下载边解压到 uploads 与旧版下载、解压、移动三步的对比
+运行：python -m tests.bench_ingest [gcode 大小 MB，默认 64]
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import io
+import os
+import sys
+import time
+import shutil
+import tarfile
+import tempfile
+import threading
+
+import requests
+
+from octoprint_raisecloud.printer_manage import PrinterManager, DownloadReader
+from tests.test_download import ThreadingServer, FileHandler
+
+
+class Settings(object):
+
+    def get_int(self, path):
+        return 0
+
+    def get_boolean(self, path):
+        return False
+
+
+class Printer(object):
+
+    def is_printing(self):
+        return False
+
+    def is_paused(self):
+        return False
+
+
+class Plugin(object):
+    _printer = Printer()
+
+    def get_settings(self):
+        return Settings()
+
+
+def make_archive(size):
+    # 近似真实 gcode 的文本，压缩率与切片结果接近
+    lines = []
+    i = 0
+    while i < size:
+        line = "G1 X%.3f Y%.3f E%.5f\n" % ((i * 7 % 30000) / 100.0, (i * 13 % 30000) / 100.0, i / 1e6)
+        lines.append(line)
+        i += len(line)
+    payload = "".join(lines).encode("ascii")
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        info = tarfile.TarInfo("job/job.gcode")
+        info.size = len(payload)
+        tar.addfile(info, io.BytesIO(payload))
+    return buf.getvalue(), len(payload)
+
+
+def baseline(url, data_folder, uploads):
+    # 旧版：下载压缩包到数据目录，解压到 uncompress，再移动到 uploads
+    zip_path = os.path.join(data_folder, "compress", "tmp.tar.gz")
+    unzip_path = os.path.join(data_folder, "uncompress")
+    os.makedirs(os.path.dirname(zip_path))
+    os.makedirs(unzip_path)
+    r = requests.get(url, stream=True, timeout=(10.0, 60.0))
+    with open(zip_path, "wb") as compress_file:
+        for chunk in r.iter_content(chunk_size=100000):
+            compress_file.write(chunk)
+    tar = tarfile.open(zip_path, "r:gz")
+    name = [n for n in tar.getnames() if n.endswith(".gcode")][0]
+    tar.extract(name, unzip_path)
+    tar.close()
+    os.remove(zip_path)
+    target = os.path.join(uploads, "job.gcode")
+    shutil.move(os.path.join(unzip_path, name), target)
+    return target
+
+
+def streaming(url, data_folder, uploads):
+    manager = PrinterManager.__new__(PrinterManager)
+    manager.plugin = Plugin()
+    tmp_path = manager.extract_gcode(DownloadReader(url, lambda: False), uploads)
+    target = os.path.join(uploads, "job.gcode")
+    os.rename(tmp_path, target)
+    return target
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 64 * 1024 * 1024
+    blob, gcode_size = make_archive(size)
+    server = ThreadingServer(("127.0.0.1", 0), FileHandler)
+    server.blob = blob
+    server.etag = '"bench"'
+    server.drops = 0
+    server.drop_after = 0
+    server.bytes_sent = 0
+    server.requests = []
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/job.tar.gz".format(server.server_address[1])
+    print("archive %.1f MB, gcode %.1f MB" % (len(blob) / 1048576.0, gcode_size / 1048576.0))
+    try:
+        for name, ingest, written in (("download+extract+move", baseline, len(blob) + gcode_size),
+                                      ("stream extract", streaming, gcode_size)):
+            folder = tempfile.mkdtemp()
+            try:
+                data_folder = os.path.join(folder, "data")
+                uploads = os.path.join(folder, "uploads")
+                os.makedirs(uploads)
+                started = time.time()
+                target = ingest(url, data_folder, uploads)
+                elapsed = time.time() - started
+                assert os.path.getsize(target) == gcode_size
+                print("%-22s %6.2f s to printable file, %6.1f MB written" % (name, elapsed, written / 1048576.0))
+            finally:
+                shutil.rmtree(folder)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# coding=utf-8
+"""
+远程文件浏览翻页：每页都列目录并排序（旧版）与 ListingIndex 缓存排好序的列表的对比
+运行：python -m tests.bench_listing [文件数，默认 10000]
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import sys
+import time
+import random
+
+from octoprint_raisecloud.printer_manage import PrinterManager
+from octoprint_raisecloud.folder_index import ListingIndex
+
+PAGE_SIZE = 5
+BASELINE_PAGES = 100  # 旧版每页都要完整列目录，只抽样前 100 页
+
+
+class FileManager(object):
+    """
+    与 OctoPrint list_files 返回格式相同的目录，统计调用次数
+    """
+
+    def __init__(self, count):
+        rng = random.Random(1)
+        self.calls = 0
+        self.entries = dict()
+        for i in range(count):
+            name = "part_%06d_%s.gcode" % (rng.randint(0, 10 ** 6), i)
+            self.entries[name] = {"name": name, "display": name, "typePath": ["machinecode", "gcode"],
+                                  "date": 1600000000 + i, "size": rng.randint(10 ** 5, 10 ** 8)}
+        for i in range(count // 100):
+            name = "folder_%04d" % i
+            self.entries[name] = {"name": name, "display": name, "typePath": ["folder"], "children": {}}
+
+    def list_files(self, path=None, filter=None, recursive=False):
+        self.calls += 1
+        # OctoPrint 每次调用都会重新生成字典
+        return {"local": dict((k, dict(v)) for k, v in self.entries.items())}
+
+
+class Plugin(object):
+
+    def __init__(self, file_manager):
+        self._file_manager = file_manager
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    file_manager = FileManager(count)
+    manager = PrinterManager.__new__(PrinterManager)
+    manager.plugin = Plugin(file_manager)
+    manager.listing_index = ListingIndex(manager.list_dir)
+    total = len(file_manager.entries)
+    pages = -(-total // PAGE_SIZE)
+
+    started = time.time()
+    for page in range(BASELINE_PAGES):
+        manager.list_dir("RaiseCloud-File")[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+    baseline = (time.time() - started) / BASELINE_PAGES
+    print("%d entries, %d pages of %d" % (total, pages, PAGE_SIZE))
+    print("list and sort per page: %7.2f ms/page, all pages ~%6.1f s, %d list_files calls" %
+          (baseline * 1000, baseline * pages, pages))
+
+    file_manager.calls = 0
+    started = time.time()
+    manager.get_files("/local/RaiseCloud-File", start=0, length=PAGE_SIZE)
+    first = time.time() - started
+    started = time.time()
+    for page in range(1, pages):
+        result = manager.get_files("/local/RaiseCloud-File/", start=page * PAGE_SIZE, length=PAGE_SIZE)
+    rest = time.time() - started
+    assert result["file_list_count"] == total
+    print("ListingIndex:           first page %6.2f ms, remaining %d pages %6.2f ms, %d list_files calls" %
+          (first * 1000, pages - 1, rest * 1000, file_manager.calls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# coding=utf-8
+"""
+快照编码：各 SNAPSHOT_PROFILES 档位下 Webcam.encode 每帧的耗时与大小
+运行：python -m tests.bench_snapshot [源图宽x高，默认 1920x1080] [每档帧数，默认 50]
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import io
+import sys
+import time
+import random
+
+from octoprint_raisecloud.webcam import Webcam, SNAPSHOT_PROFILES, pil_image
+
+ORDER = ("original", "hd", "sd", "low")
+
+
+def make_frame(width, height):
+    # 渐变加噪点，压缩率与摄像头画面接近
+    Image = pil_image()
+    rng = random.Random(1)
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    noise = Image.frombytes("L", (width, height), bytes(bytearray(rng.randint(0, 48) for _ in range(width * height))))
+    image = Image.merge("RGB", [Image.blend(band, noise, 0.3) for band in image.split()])
+    buf = io.BytesIO()
+    image.save(buf, format="jpeg", quality=90)
+    return buf.getvalue()
+
+
+def main():
+    if not pil_image():
+        print("Pillow is not installed")
+        sys.exit(1)
+    width, height = (int(v) for v in (sys.argv[1] if len(sys.argv) > 1 else "1920x1080").split("x"))
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    pic = make_frame(width, height)
+    webcam = Webcam.__new__(Webcam)
+    print("source %dx%d, %.1f KB" % (width, height, len(pic) / 1024.0))
+    for name in ORDER:
+        size, quality = SNAPSHOT_PROFILES[name]
+        webcam.encode(pic, [], quality=quality, size=size)  # 预热
+        started = time.time()
+        for _ in range(frames):
+            data = webcam.encode(pic, [], quality=quality, size=size)
+        elapsed = (time.time() - started) / frames
+        print("%-8s %-9s q%-3d %7.2f ms/frame %8.1f KB/frame" % (
+            name, "%dx%d" % size if size else "-", quality, elapsed * 1000, len(data) / 1024.0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# coding=utf-8
+"""
+SqliteServer 每线程长连接与旧版每条语句重新连接的对比
+运行：python -m tests.bench_sqlite
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import time
+import shutil
+import sqlite3
+import tempfile
+
+from octoprint_raisecloud.sqlite_util import SqliteServer
+
+ROUNDS = 2000
+
+
+class Plugin(object):
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def get_plugin_data_folder(self):
+        return self.folder
+
+
+class ConnectPerStatement(object):
+    """
+    基线版本的写法：每次查询或更新都重新打开连接，执行后关闭
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_conn(self):
+        conn = sqlite3.connect(self.path)
+        conn.text_factory = str
+        return conn
+
+    def fetchone(self, sql, data):
+        conn = self.get_conn()
+        cu = conn.cursor()
+        cu.execute(sql, (data,))
+        r = cu.fetchall()
+        cu.close()
+        conn.close()
+        return r[0] if r else None
+
+    def update(self, sql, data):
+        conn = self.get_conn()
+        cu = conn.cursor()
+        for d in data:
+            cu.execute(sql, d)
+            conn.commit()
+        cu.close()
+        conn.close()
+
+
+def run(server, rounds):
+    started = time.time()
+    for i in range(rounds):
+        server.update('UPDATE profile SET task_id = ? WHERE id = ? ', [(str(i), 1)])
+        server.fetchone('SELECT task_id FROM profile WHERE id = ? ', 1)
+    return rounds * 2 / (time.time() - started)
+
+
+def main():
+    folder = tempfile.mkdtemp()
+    try:
+        server = SqliteServer(Plugin(folder))
+        server.init_db()
+        server.insert('INSERT INTO profile (id, task_id) values (?, ?)', [(1, "")])
+        persistent = run(server, ROUNDS)
+        server.close_all()
+        baseline = run(ConnectPerStatement(server.path), ROUNDS)
+        print("connect per statement: %8.0f ops/s" % baseline)
+        print("persistent connection: %8.0f ops/s  (%.1fx)" % (persistent, persistent / baseline))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# coding=utf-8
+"""
+打印机回调触发上报与旧版每 5 秒轮询的对比：回调到入队的延迟，以及每分钟占用的 CPU 时间
+运行：python -m tests.bench_telemetry [每种方式的运行秒数，默认 30]
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import sys
+import time
+import random
+import threading
+
+import octoprint_raisecloud.cloud_task as cloud_task
+from octoprint_raisecloud.cloud_task import CloudTask, TelemetryCallback
+from octoprint_raisecloud.delta import DeltaEngine
+
+thread_time = getattr(time, "thread_time", time.process_time)
+
+
+class Settings(object):
+    values = {"telemetry_coalesce_ms": 250, "telemetry_resync_interval": 3600}
+
+    def get_int(self, path):
+        return self.values[path[0]]
+
+
+class Plugin(object):
+    _settings = Settings()
+
+
+class Outbox(object):
+    pending = False
+
+    def pop_all(self):
+        return []
+
+
+class SqliteServer(object):
+
+    def __init__(self):
+        self.logout_event = threading.Event()
+
+
+class FakeWebsocket(object):
+    """
+    代替云端连接，记录每条状态上报入队的时间
+    """
+    queue = type(str("Queue"), (object,), {"maxsize": 100})
+
+    def __init__(self, url, on_server_ws_msg, on_undelivered=None):
+        pass
+
+    def run(self):
+        pass
+
+    def connected(self):
+        return not Printer.stopped.is_set()
+
+    def metrics(self):
+        return {"depth": 0}
+
+    def send_text(self, data):
+        if data.get("message_type") == 1 and "nozzle_temp_1" in data["data"]:
+            Printer.sent.append((time.time(), data["data"]["nozzle_temp_1"]))
+        return True
+
+    def disconnect(self):
+        pass
+
+
+class Printer(object):
+    """
+    模拟打印机温度报告：间隔 1~3 秒，每次温度变化 2 度
+    """
+    stopped = threading.Event()
+    sent = []
+    changed = dict()
+    temperature = 200
+
+    @classmethod
+    def send_data(cls):
+        return {"message_type": 1, "machine_id": "bench", "token": "bench",
+                "data": {"cur_print_state": "running", "nozzle_temp_1": cls.temperature}}
+
+
+def make_task():
+    task = CloudTask.__new__(CloudTask)
+    task.plugin = Plugin()
+    task.websocket = None
+    task.outbox = Outbox()
+    task.sqlite_server = SqliteServer()
+    task.delta_engine = DeltaEngine()
+    task._push_event = threading.Event()
+    task._get_send_data = Printer.send_data
+    task.send_heartbeat = lambda: None
+    task.resolve_addr = lambda domain: "127.0.0.1"
+    return task
+
+
+def poll_loop(task):
+    # 基线版本：每 5 秒读取一次状态
+    while not Printer.stopped.is_set():
+        task.send_printer_info()
+        Printer.stopped.wait(5)
+
+
+def measure(name, target, task, duration, callback=None):
+    Printer.stopped.clear()
+    Printer.sent[:] = []
+    Printer.changed.clear()
+    cpu = dict()
+
+    def run():
+        started = thread_time()
+        try:
+            target(task)
+        finally:
+            cpu["seconds"] = thread_time() - started
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    time.sleep(2.5)  # event_loop 连接后等待 2 秒
+    rng = random.Random(1)
+    end = time.time() + duration
+    while time.time() < end:
+        time.sleep(rng.uniform(1, 3))
+        Printer.temperature += 2
+        Printer.changed[Printer.temperature] = time.time()
+        if callback:
+            callback.on_printer_add_temperature(None)
+    Printer.stopped.set()
+    task.sqlite_server.logout_event.set()
+    task._push_event.set()
+    thread.join()
+    # 每次温度变化到包含该值（或更新值）的上报入队的时间
+    latencies = []
+    for value, changed in Printer.changed.items():
+        delivered = [sent for sent, sent_value in Printer.sent if sent_value >= value]
+        if delivered:
+            latencies.append(min(delivered) - changed)
+    latencies.sort()
+    print("%-8s updates %3d, frames %3d, latency avg %5.0f ms, p95 %5.0f ms, cpu %.1f ms/min" % (
+        name, len(Printer.changed), len(Printer.sent), 1000 * sum(latencies) / max(len(latencies), 1),
+        1000 * latencies[int(len(latencies) * 0.95)] if latencies else 0,
+        1000 * cpu["seconds"] * 60 / (duration + 2.5)))
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 30
+    cloud_task.WebsocketServer = FakeWebsocket
+    cloud_task.ReconnectionPolicy = lambda: type(str("Policy"), (object,), {"reset": lambda self: None,
+                                                                            "more": lambda self: None})()
+    task = make_task()
+    task.websocket = FakeWebsocket(None, None)
+    measure("poll 5s", poll_loop, task, duration)
+    task = make_task()
+    measure("push", CloudTask.event_loop, task, duration, callback=TelemetryCallback(task))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from octoprint_raisecloud.printer_manage import DownloadReader, SegmentedDownload
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """
+    支持 Range/If-Range 的下载服务，前 drops 个响应只发送 drop_after 字节就断开连接
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        blob = server.blob
+        start, end, status = 0, len(blob) - 1, 200
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if match and (if_range is None or if_range == server.etag):
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+            status = 206
+        body = blob[start:end + 1]
+        with server.lock:
+            server.requests.append(self.headers.get("Range"))
+            drop = server.drops > 0 and len(body) > server.drop_after
+            if drop:
+                server.drops -= 1
+            body_sent = body[:server.drop_after] if drop else body
+            server.bytes_sent += len(body_sent)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", server.etag)
+        if status == 206:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, len(blob)))
+        self.end_headers()
+        self.wfile.write(body_sent)
+        self.wfile.flush()
+        if drop:
+            # 模拟连接中途断开
+            self.close_connection = True
+            self.connection.shutdown(2)
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingServer(("127.0.0.1", 0), FileHandler)
+        self.server.blob = os.urandom(3 * 1024 * 1024 + 123)
+        self.server.etag = '"{}"'.format(hashlib.md5(self.server.blob).hexdigest())
+        self.server.drops = 0
+        # 断开位置与读取块大小对齐，续传时不会重复传输已读取的数据
+        self.server.drop_after = 4 * CHUNK_SIZE
+        self.server.bytes_sent = 0
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:{}/job.tar.gz".format(self.server.server_address[1])
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def read_all(self, reader):
+        data = []
+        chunk = reader.read(65536)
+        while chunk:
+            data.append(chunk)
+            chunk = reader.read(65536)
+        reader.close()
+        return b"".join(data)
+
+    def test_reader_resumes_after_disconnects(self):
+        self.server.drops = 3
+        reader = DownloadReader(self.url, lambda: False, retry_times=2, chunk_size=CHUNK_SIZE)
+        self.assertEqual(self.read_all(reader), self.server.blob)
+        # 每次续传只请求剩余部分，总传输量等于文件大小
+        self.assertEqual(self.server.bytes_sent, len(self.server.blob))
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertIsNone(self.server.requests[0])
+        self.assertEqual(self.server.requests[1], "bytes={}-".format(self.server.drop_after))
+
+    def test_reader_fails_when_file_changes(self):
+        self.server.drops = 1
+        reader = DownloadReader(self.url, lambda: False, chunk_size=CHUNK_SIZE)
+        self.assertTrue(reader.read(65536))
+        # 连接断开前文件在服务器上被替换，If-Range 不匹配时服务器返回完整文件，不能拼接
+        self.server.etag = '"changed"'
+        with self.assertRaises(IOError):
+            self.read_all(reader)
+
+    def test_segmented_download_resumes_segments(self):
+        self.server.drops = 4
+        path = os.path.join(self.folder, "job.part")
+        open(path, "wb").close()
+        download = SegmentedDownload(self.url, lambda: False, 4, chunk_size=CHUNK_SIZE)
+        download.MIN_SEGMENT_SIZE = 512 * 1024
+        self.assertTrue(download.run(path))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.server.blob)
+        # 探测请求只传输 1 字节，中断的分段从断点续传
+        self.assertEqual(self.server.bytes_sent, len(self.server.blob) + 1)
+        self.assertEqual(len(self.server.requests), 1 + 4 + 4)
+        self.assertEqual(download.md5, hashlib.md5(self.server.blob).hexdigest())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+# coding=utf-8
+from __future__ import absolute_import, unicode_literals
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+# 只在用到时才导入的模块，插件加载时不应出现
+LAZY_MODULES = ("PIL", "requests_toolbelt", "Crypto", "psutil", "websocket", "tarfile", "multiprocessing.pool")
+
+SCRIPT = """
+import sys, json, threading
+before = threading.active_count()
+import octoprint_raisecloud
+print(json.dumps({"modules": [m for m in %r if m in sys.modules],
+                  "threads": threading.active_count() - before}))
+""" % (LAZY_MODULES,)
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_import_is_lazy(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, "-c", SCRIPT], cwd=root)
+        result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        self.assertEqual(result["modules"], [])
+        self.assertEqual(result["threads"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()